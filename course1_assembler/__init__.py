@@ -1 +1 @@
-from .hack_assembler import check_answer
\ No newline at end of file
+from .hack_assembler import check_answer, assemble, render_text
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""
+
+Throughput benchmark for hack_assembler.py
+Generates synthetic .asm programs, assembles them in a fresh process per run and reports
+lines/sec and peak RSS. Results are appended to a JSON file so runs can be compared over time
+
+usage: python benchmark.py --lines 1000000 --mix all --modes two-pass,single-pass,jobs
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+ASSEMBLER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# relative weights of each kind of source line for the workload mixes
+# label: label definition, label_ref: @LABEL, var: @variable, const: @123 / @SP, c: C instruction
+MIXES = {
+    "label-heavy": {"label": 20, "label_ref": 30, "var": 5, "const": 10, "c": 35},
+    "variable-heavy": {"label": 1, "label_ref": 4, "var": 45, "const": 5, "c": 45},
+    "a-heavy": {"label": 1, "label_ref": 10, "var": 10, "const": 60, "c": 19},
+    "c-heavy": {"label": 1, "label_ref": 3, "var": 3, "const": 3, "c": 90},
+}
+
+# how each mode is passed to hack_assembler.main
+MODES = {
+    "two-pass": {},
+    "single-pass": {"single_pass": True},
+    "jobs": {"jobs": None},
+}
+
+C_INSTRUCTIONS = [
+    "D=M", "M=D", "A=M", "D=A", "AM=M-1", "M=M+1", "D=D+A", "D=D-M", "M=D|M", "M=!M", "M=-M",
+    "D;JGT", "D;JEQ", "D;JNE", "D;JLT", "0;JMP", "AMD=D+1", "MD=M-1",
+]
+CONSTANTS = ["@SP", "@LCL", "@ARG", "@THIS", "@THAT", "@R13", "@R15", "@SCREEN", "@KBD", "@0", "@1", "@256", "@32767"]
+
+# labels are only ever defined in the first 32K instructions so every reference fits in an A instruction
+ROM_SIZE = 32768
+# variables live in RAM 16 up to the screen
+MAX_VARIABLES = 16384 - 16
+
+
+"""
+purpose: write a synthetic .asm program
+input: output path, number of source lines, mix name, seed
+output: [number of source lines, number of instructions]
+lines are written as they are generated, so very large programs can be made without much memory
+"""
+def generate_program(path, lines, mix, seed=0):
+    rng = random.Random(seed)
+    weights = MIXES[mix]
+    kinds = list(weights)
+    cumulative = []
+    total = 0
+    for kind in kinds:
+        total += weights[kind]
+        cumulative.append(total)
+
+    # plan how many labels fit in ROM for this size, all names are fixed up front
+    # so references to labels later in the file are forward references
+    label_count = max(1, min(lines, ROM_SIZE - 1) * weights["label"] // total)
+    variable_count = max(1, min(MAX_VARIABLES, lines * weights["var"] // total // 4 + 1))
+    # any labels the random draw hasn't placed by this instruction are all defined there
+    expected_instructions = (lines - 1) * (total - weights["label"]) // total
+    last_label_address = min(ROM_SIZE - 1, expected_instructions) * 9 // 10
+    defined_labels = 0
+    instruction_count = 0
+
+    with open(path, "w") as f:
+        f.write(f"// synthetic {mix} program, {lines} lines, seed {seed}\n")
+        for _ in range(lines - 1):
+            kind = rng.choices(kinds, cum_weights=cumulative)[0]
+            if kind == "label":
+                if defined_labels < label_count and instruction_count < ROM_SIZE - 1:
+                    f.write(f"(L{defined_labels})\n")
+                    defined_labels += 1
+                    continue
+                kind = "c"
+            if instruction_count == last_label_address:
+                while defined_labels < label_count:
+                    f.write(f"(L{defined_labels})\n")
+                    defined_labels += 1
+            if kind == "label_ref":
+                f.write(f"@L{rng.randrange(label_count)}\n")
+            elif kind == "var":
+                f.write(f"@v{rng.randrange(variable_count)}\n")
+            elif kind == "const":
+                f.write(rng.choice(CONSTANTS) + "\n")
+            else:
+                f.write(rng.choice(C_INSTRUCTIONS) + "\n")
+            instruction_count += 1
+
+        # make sure every referenced label exists, only needed for tiny programs
+        for i in range(defined_labels, label_count):
+            f.write(f"(L{i})\n")
+
+    return [lines, instruction_count]
+
+
+# runs one assembly in a child process so peak RSS is measured for that run only
+CHILD_SCRIPT = """
+import sys, json, time
+sys.path.insert(0, sys.argv[1])
+import hack_assembler
+kwargs = json.loads(sys.argv[3])
+start = time.perf_counter()
+hack_assembler.main(sys.argv[2], **kwargs)
+print(time.perf_counter() - start)
+"""
+
+
+"""
+purpose: assemble one program in a fresh interpreter
+input: .asm path, keyword arguments for hack_assembler.main
+output: [seconds spent in main, peak RSS in KB or None if the platform can't report it]
+"""
+def time_assembly(path, kwargs):
+    child = subprocess.Popen(
+        [sys.executable, "-c", CHILD_SCRIPT, ASSEMBLER_DIR, path, json.dumps(kwargs)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    output = child.stdout.read()
+    child.stdout.close()
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(child.pid, 0)
+        child.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is KB on linux but bytes on macOS
+        peak_rss = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    else:
+        child.wait()
+        peak_rss = None
+    if child.returncode != 0:
+        raise RuntimeError(f"assembling {path} with {kwargs} failed")
+    return [float(output.strip().splitlines()[-1]), peak_rss]
+
+
+# generated programs (and their assembled output) go in workdir and are kept there,
+# without a workdir they go in a temp dir that is removed afterwards
+def run_benchmarks(lines, mixes, modes, jobs=2, repeat=1, seed=0, workdir=None):
+    if workdir is None:
+        with tempfile.TemporaryDirectory(prefix="hack_bench_") as tempdir:
+            return run_benchmarks(lines, mixes, modes, jobs, repeat, seed, tempdir)
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for mix in mixes:
+        path = os.path.join(workdir, f"{mix}_{lines}.asm")
+        source_lines, instruction_count = generate_program(path, lines, mix, seed)
+        for mode in modes:
+            kwargs = dict(MODES[mode])
+            if "jobs" in kwargs:
+                kwargs["jobs"] = jobs
+            # best of repeat runs, like timeit
+            runs = [time_assembly(path, kwargs) for _ in range(repeat)]
+            seconds = min(run[0] for run in runs)
+            rss = [run[1] for run in runs if run[1] is not None]
+            results.append({
+                "mix": mix,
+                "mode": mode if mode != "jobs" else f"jobs={jobs}",
+                "lines": source_lines,
+                "instructions": instruction_count,
+                "seconds": round(seconds, 4),
+                "lines_per_sec": round(source_lines / max(seconds, 1e-9)),
+                "peak_rss_kb": max(rss) if rss else None,
+            })
+            print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    rss = f"{result['peak_rss_kb'] / 1024:.1f} MB" if result["peak_rss_kb"] is not None else "n/a"
+    print(f"{result['mix']:<15} {result['mode']:<12} {result['lines']:>10} lines "
+          f"{result['seconds']:>9.3f}s {result['lines_per_sec']:>10} lines/s  peak {rss}")
+
+
+# results file holds a list of runs, newest last
+def load_runs(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_run(path, run):
+    runs = load_runs(path)
+    runs.append(run)
+    with open(path, "w") as f:
+        json.dump(runs, f, indent=2)
+
+
+# prints the speed of each result relative to the same mix/mode/size in an earlier run
+def compare(previous, current):
+    before = {(r["mix"], r["mode"], r["lines"]): r for r in previous["results"]}
+    print(f"\ncompared with run '{previous['name']}' ({previous['time']}):")
+    for result in current["results"]:
+        old = before.get((result["mix"], result["mode"], result["lines"]))
+        if not old:
+            continue
+        speedup = result["lines_per_sec"] / old["lines_per_sec"]
+        print(f"{result['mix']:<15} {result['mode']:<12} {speedup:6.2f}x lines/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark hack_assembler.py on synthetic programs")
+    parser.add_argument("--lines", type=int, default=200000, help="source lines per generated program")
+    parser.add_argument("--mix", default="all", help=f"comma separated mixes from {', '.join(MIXES)} or 'all'")
+    parser.add_argument("--modes", default="two-pass,single-pass", help=f"comma separated modes from {', '.join(MODES)}")
+    parser.add_argument("--jobs", type=int, default=2, help="worker processes for the jobs mode")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="where generated programs are kept, created if needed (default: a temp dir removed afterwards)")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file the run is appended to")
+    parser.add_argument("--name", default="", help="label stored with the run")
+    args = parser.parse_args()
+
+    mixes = list(MIXES) if args.mix == "all" else args.mix.split(",")
+    modes = args.modes.split(",")
+    for name in mixes:
+        if name not in MIXES:
+            parser.error(f"unknown mix {name}")
+    for name in modes:
+        if name not in MODES:
+            parser.error(f"unknown mode {name}")
+
+    results = run_benchmarks(args.lines, mixes, modes, args.jobs, args.repeat, args.seed, args.workdir)
+    run = {
+        "name": args.name,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    previous = load_runs(args.output)
+    save_run(args.output, run)
+    if previous:
+        compare(previous[-1], run)
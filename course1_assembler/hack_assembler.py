@@ -1,97 +1,396 @@
+import os
 import sys
+import argparse
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+# comp bits (a bit included, so M versions already have it set):
+comp_dict = {
+    "0": 0b0101010,
+    "1": 0b0111111,
+    "-1": 0b0111010,
+    "D": 0b0001100,
+    "A": 0b0110000,
+    "M": 0b1110000,
+    "!D": 0b0001101,
+    "!A": 0b0110001,
+    "!M": 0b1110001,
+    "-D": 0b0001111,
+    "-A": 0b0110011,
+    "-M": 0b1110011,
+    "D+1": 0b0011111,
+    "A+1": 0b0110111,
+    "M+1": 0b1110111,
+    "D-1": 0b0001110,
+    "A-1": 0b0110010,
+    "M-1": 0b1110010,
+    "D+A": 0b0000010,
+    "D+M": 0b1000010,
+    "D-A": 0b0010011,
+    "D-M": 0b1010011,
+    "A-D": 0b0000111,
+    "M-D": 0b1000111,
+    "D&A": 0b0000000,
+    "D&M": 0b1000000,
+    "D|A": 0b0010101,
+    "D|M": 0b1010101
+}
+
+# dest bits:
+dest_dict = {
+    'null': 0b000,
+    'M': 0b001,
+    'D': 0b010,
+    'MD': 0b011,
+    'A': 0b100,
+    'AM': 0b101,
+    'AD': 0b110,
+    'AMD': 0b111,
+}
+
+# jump bits:
+jump_dict = {
+    'null': 0b000,
+    'JGT': 0b001,
+    'JEQ': 0b010,
+    'JGE': 0b011,
+    'JLT': 0b100,
+    'JNE': 0b101,
+    'JLE': 0b110,
+    'JMP': 0b111,
+}
+
+# process symbols:
+# variables, label, pre-defined
+predefined_symbols = {
+    'SP': 0,
+    'LCL': 1,
+    'ARG': 2,
+    'THIS': 3,
+    'THAT': 4,
+    'R0': 0,
+    'R1': 1,
+    'R2': 2,
+    'R3': 3,
+    'R4': 4,
+    'R5': 5,
+    'R6': 6,
+    'R7': 7,
+    'R8': 8,
+    'R9': 9,
+    'R10': 10,
+    'R11': 11,
+    'R12': 12,
+    'R13': 13,
+    'R14': 14,
+    'R15': 15,
+    'SCREEN': 16384,
+    'KBD': 24576,
+    # misspelled name kept so older programs still assemble
+    'KDB': 24576,
+}
+
+
+# yields each line of the asm file one at a time (without the newline)
+# so the whole program never has to be held in memory
+def read_lines(file):
+    with open(file, "r") as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+# builds the 16 bit word for an A instruction: 0 followed by a 15 bit value
+def a_instruction(value):
+    value = int(value)
+    if value > 0x7FFF:
+        raise ValueError(f"A instruction value {value} does not fit in 15 bits")
+    return value
+
+
+# builds the 16 bit word for a C instruction
+def c_instruction(line):
+    # syntax: dest = comp; jump
+    # need to break into dest, comp, and jump, then look up each part for correlating bits, then combine
+    if "=" in line:
+        dest, comp = line.split("=")
+        jump = "null"
+    elif ";" in line:
+        comp, jump = line.split(";")
+        dest = "null"
+    else:
+        print(line)
+        print("error no operation?")
+
+    # c-instruction starts with "111"
+    # full breakdown: 1, 1, 1, a, c1, c2, c3, c4, c5, c6, d1, d2, d3, j1, j2, j3
+    return 0xE000 | (comp_dict[comp] << 6) | (dest_dict[dest] << 3) | jump_dict[jump]
+
+
+# renders a machine word as the 16 character line used in .hack files
+def word_to_text(word):
+    return format(word, '016b')
+
+
+# renders machine words as the text of a .hack file (one line per word, no trailing newline)
+def render_text(words):
+    return '\n'.join(map(word_to_text, words))
+
+
+# packs words into the bytes of a little endian uint16 image
+def words_to_bytes(words):
+    image = array('H', words)
+    if sys.byteorder == 'big':
+        image.byteswap()
+    return image.tobytes()
+
+
+# writes words as a text .hack file (no trailing newline), joining them in blocks
+def write_hack_text(file_name, words, block_size=4096):
+    with open(file_name, "w") as f:
+        for start in range(0, len(words), block_size):
+            if start > 0:
+                f.write('\n')
+            f.write(render_text(words[start:start + block_size]))
+
+
+# writes words as a packed uint16 image in a single write, so it can be mmap'd by a loader
+def write_hack_binary(file_name, words):
+    with open(file_name, "wb") as f:
+        f.write(words_to_bytes(words))
+
+
+# splits a C instruction into [dest, comp, jump]
+def c_fields(line):
+    if "=" in line:
+        dest, comp = line.split("=")
+        return [dest, comp, "null"]
+    comp, jump = line.split(";")
+    return ["null", comp, jump]
+
+
+# returns the label name if the line is a label, else None
+def label_name(line):
+    if '(' in line and ')' in line:
+        return (line.split('(')[1]).split(')')[0]
+    return None
+
+
+def is_jump(line):
+    return ';' in line
+
+
+def is_unconditional_jump(line):
+    return line.endswith(';JMP')
+
+
+"""
+purpose: decide whether the value an A instruction loads is never used
+input: [(raw index, line)] program view, position of the instruction after the A instruction
+output: True if, along the fall through path, A is overwritten before anything reads it
+labels are only join points, so they don't stop the scan. anything that reads A (A or M in comp,
+writing M, any jump) makes it live, a new A instruction or writing A makes it dead
+"""
+def a_is_dead(code, pos):
+    while pos < len(code):
+        line = code[pos][1]
+        pos += 1
+        if label_name(line) is not None:
+            continue
+        if line[0] == '@':
+            return True
+        dest, comp, jump = c_fields(line)
+        if 'A' in comp or 'M' in comp or 'M' in dest or jump != "null":
+            return False
+        if 'A' in dest:
+            return True
+    # falls off the end of the program, keep it
+    return False
+
+
+# non blank, non comment lines as [(raw index, stripped line)]
+def program_view(lines):
+    code = []
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if line and line[0] != '/':
+            code.append((i, line))
+    return code
+
+
+# position in code of the first instruction at or after pos (skips labels)
+def next_instruction(code, pos):
+    while pos < len(code) and label_name(code[pos][1]) is not None:
+        pos += 1
+    return pos
+
+
+# jump threading: @L followed by a jump, where L starts with @M / unconditional jump, becomes @M
+def thread_jumps(lines):
+    code = program_view(lines)
+    label_pos = {}
+    for pos, (_, line) in enumerate(code):
+        name = label_name(line)
+        if name is not None:
+            label_pos[name] = pos
+
+    def final_target(name):
+        seen = set()
+        while name in label_pos and name not in seen:
+            seen.add(name)
+            pos = next_instruction(code, label_pos[name])
+            if (pos + 1 < len(code) and code[pos][1][0] == '@'
+                    and is_unconditional_jump(code[pos + 1][1])):
+                name = code[pos][1][1:]
+            else:
+                break
+        return name
+
+    changed = 0
+    for pos in range(len(code) - 1):
+        i, line = code[pos]
+        if line[0] == '@' and is_jump(code[pos + 1][1]):
+            target = final_target(line[1:])
+            if target != line[1:]:
+                lines[i] = '@' + target
+                changed += 1
+    return changed
+
+
+# removes @L / jump pairs that only jump to the instruction right after them,
+# as long as the code there doesn't read the A value the jump leaves behind
+def remove_jumps_to_next(lines):
+    code = program_view(lines)
+    removed = 0
+    pos = 0
+    while pos < len(code) - 1:
+        i, line = code[pos]
+        if line[0] == '@' and is_jump(code[pos + 1][1]):
+            following = pos + 2
+            landing_labels = set()
+            while following < len(code) and label_name(code[following][1]) is not None:
+                landing_labels.add(label_name(code[following][1]))
+                following += 1
+            if line[1:] in landing_labels and a_is_dead(code, following):
+                lines[i] = ''
+                lines[code[pos + 1][0]] = ''
+                removed += 2
+                pos = following
+                continue
+        pos += 1
+    return removed
+
+
+# removes code after an unconditional jump up to the next label something refers to
+def remove_unreachable(lines):
+    code = program_view(lines)
+    referenced = set()
+    for _, line in code:
+        if line[0] == '@':
+            referenced.add(line[1:])
+    removed = 0
+    reachable = True
+    for i, line in code:
+        name = label_name(line)
+        if name is not None:
+            if name in referenced:
+                reachable = True
+            elif not reachable:
+                # nothing can get here, drop the label too
+                lines[i] = ''
+            continue
+        if not reachable:
+            lines[i] = ''
+            removed += 1
+        elif is_unconditional_jump(line):
+            reachable = False
+    return removed
+
+
+# removes A instructions whose value is overwritten before it is used
+def remove_dead_a_loads(lines):
+    code = program_view(lines)
+    removed = 0
+    for pos, (i, line) in enumerate(code):
+        if line[0] == '@' and a_is_dead(code, pos + 1):
+            lines[i] = ''
+            removed += 1
+    return removed
+
+
+# true if the program jumps straight to a numeric ROM address (like the course's Pong.asm does
+# for its shared subroutines). removing any instruction would move those targets
+def has_numeric_jumps(lines):
+    code = program_view(lines)
+    for pos in range(len(code) - 1):
+        line = code[pos][1]
+        if line[0] == '@' and line[1:].isdigit() and is_jump(code[pos + 1][1]):
+            return True
+    return False
+
+
+"""
+purpose: peephole optimize a program before it is encoded
+input: list of raw asm lines
+output: [optimized lines, number of instructions removed or None if the program was left alone]
+removed lines are blanked rather than deleted so line numbers (used by the listing) still match the source.
+passes are repeated until none of them finds anything more:
+- jumps to a label that just jumps on are threaded to the final target
+- jumps to the very next instruction are removed
+- code after an unconditional jump that can't be reached is removed
+- A loads that are overwritten before being read are removed (eg. back to back @SP)
+all of this assumes code addresses are only ever written as labels, so a program with numeric
+jumps is returned unchanged (with None removed)
+"""
+def optimize(raw_input):
+    lines = list(raw_input)
+    if has_numeric_jumps(lines):
+        return [lines, None]
+    removed = 0
+    while True:
+        changed = thread_jumps(lines)
+        removed_now = remove_jumps_to_next(lines)
+        removed_now += remove_unreachable(lines)
+        removed_now += remove_dead_a_loads(lines)
+        removed += removed_now
+        if changed == 0 and removed_now == 0:
+            break
+    return [lines, removed]
+
+
+# what main reports about an optimize() run
+def optimizer_message(removed):
+    if removed is None:
+        return "optimizer skipped: program jumps to numeric ROM addresses"
+    return f"optimizer removed {removed} instructions"
+
+
+def main(file, single_pass=False, binary=False, jobs=1, listing=False, optimize_code=False):
+    if single_pass and jobs > 1:
+        raise ValueError("single pass mode can't be combined with jobs > 1")
+    if optimize_code and jobs > 1:
+        # the optimizer needs the whole program in memory, the parallel path never loads it
+        raise ValueError("the optimizer can't be combined with jobs > 1")
+    if single_pass:
+        return main_single_pass(file, binary, listing, optimize_code)
+    if jobs > 1:
+        return main_parallel(file, binary, jobs, listing)
 
-def main(file):
     # read in raw text line by line from asm file in sys arg
     raw_input = []
     with open(file, "r") as f:
         for line in f:
             raw_input.append(line.rstrip('\n'))
-    
-    # comp bits:
-    comp_dict = {
-        "0": "101010",
-        "1": "111111",
-        "-1": "111010",
-        "D": "001100",
-        "A": "110000",
-        "M": "110000",
-        "!D": "001101",
-        "!A": "110001",
-        "!M": "110001",
-        "-D": "001111",
-        "-A": "110011",
-        "-M": "110011",
-        "D+1": "011111",
-        "A+1": "110111",
-        "M+1": "110111",
-        "D-1": "001110",
-        "A-1": "110010",
-        "M-1": "110010",
-        "D+A": "000010",
-        "D+M": "000010",
-        "D-A": "010011",
-        "D-M": "010011",
-        "A-D": "000111",
-        "M-D": "000111",
-        "D&A": "000000",
-        "D&M": "000000",
-        "D|A": "010101",
-        "D|M": "010101"
-    }
-
-    # dest bits:
-    dest_dict = {
-        'null': '000',
-        'M': '001',
-        'D': '010',
-        'MD': '011',
-        'A': '100',
-        'AM': '101',
-        'AD': '110',
-        'AMD': '111',
-    }
-
-    # jump bits:
-    jump_dict = {
-        'null': '000',
-        'JGT': '001',
-        'JEQ': '010',
-        'JGE': '011',
-        'JLT': '100',
-        'JNE': '101',
-        'JLE': '110',
-        'JMP': '111',
-    }
+
+    if optimize_code:
+        raw_input, removed = optimize(raw_input)
+        print(optimizer_message(removed))
 
     # process symbols:
     # variables, label, pre-defined
-    symbols = {
-        'SP': '0',
-        'LCL': '1',
-        'ARG': '2',
-        'THIS': '3',
-        'THAT': '4',
-        'R0': '0',
-        'R1': '1',
-        'R2': '2',
-        'R3': '3',
-        'R4': '4',
-        'R5': '5',
-        'R6': '6',
-        'R7': '7',
-        'R8': '8',
-        'R9': '9',
-        'R10': '10',
-        'R11': '11',
-        'R12': '12',
-        'R13': '13',
-        'R14': '14',
-        'R15': '15',
-        'SCREEN': '16384',
-        'KDB': '24576'
-    }
+    symbols = dict(predefined_symbols)
 
     # find all symbols, labels, and variables to add to symbol table
+    labels = {}
     instruction_count = 0
     for line in raw_input:
         line = line.strip()
@@ -102,16 +401,21 @@ def main(file):
         # is label
         if '(' in line and ')' in line:
             label = (line.split('(')[1]).split(')')[0]
-            symbols[label] = str(instruction_count)
+            symbols[label] = instruction_count
+            labels[label] = instruction_count
             continue
 
         instruction_count += 1
     
+    hack_file_name = str(file).split('.')[0] + "_answer" + ".hack"
+    listing_writer = ListingWriter(listing_file_name(hack_file_name)) if listing else None
+    current_label = None
 
     # process without symbols to hack binary format
-    translation = []
+    translation = array('H')
+    variables = {}
     last_used_addr = 15
-    for line in raw_input:
+    for line_number, line in enumerate(raw_input, 1):
         # need to delete spaces/comments
         line = line.strip()
         if not line or line[0] == '/':
@@ -119,7 +423,11 @@ def main(file):
         
         # is label:
         if '(' in line:
+            current_label = (line.split('(')[1]).split(')')[0]
             continue
+
+        if listing_writer:
+            listing_writer.instruction(len(translation), line_number, current_label, line)
         
         if line[0] == '@':
             # is A instruction
@@ -129,88 +437,484 @@ def main(file):
             # if is variable vs. address:
             if ord(raw[0]) >= 48 and ord(raw[0]) <= 57:
                 # is raw address 
-                binOfAddress = bin(int(raw)).split('b')[-1]
+                processed_line = a_instruction(raw)
             else:
                 # is variable/symbol
-                if raw in symbols:
-                    # is label symbol
-                    binOfAddress = bin(int(symbols[raw])).split('b')[-1]
-                else:
+                if raw not in symbols:
                     # is variable symbol -> assign first available memory address
                     symbols[raw] = last_used_addr + 1
-                    binOfAddress = bin(int(symbols[raw])).split('b')[-1]
+                    variables[raw] = last_used_addr + 1
                     last_used_addr += 1
-            padding_zeros = (16 - 1 - len(binOfAddress)) * "0"
-            processed_line = "0" + padding_zeros + binOfAddress
+                processed_line = a_instruction(symbols[raw])
         else:
-            # is C instruction - will need to add condition here to filter out/handle symbols/comments
-            # syntax: dest = comp; jump
-            # need to break into dest, comp, and jump, then look up each part for correlating bits, then combine
-            
-            if "=" in line:
-                dest, comp = line.split("=")
-                jump = "null"
-            elif ";" in line:
-                comp, jump = line.split(";")
-                dest = "null"
-            else:
-                print(line)
-                print("error no operation?")
-            if "M" in comp:
-                a = "1"
-            else:
-                a = "0"
-
-            processed_line = "111" + a + comp_dict[comp] + dest_dict[dest] + jump_dict[jump]
-
-            # c-instruction starts with "111"
-            # full breakdown: 1, 1, 1, a, c1, c2, c3, c4, c5, c6, d1, d2, d3, j1, j2, j3
+            # is C instruction
+            processed_line = c_instruction(line)
         
         translation.append(processed_line)
     
+    if listing_writer:
+        listing_writer.symbols(labels, variables)
+        listing_writer.close()
+
+    write_hack_text(hack_file_name, translation)
+    if binary:
+        write_hack_binary(binary_file_name(hack_file_name), translation)
+    
+    return hack_file_name
+
+
+# packed image is written next to the text .hack file
+def binary_file_name(hack_file_name):
+    return hack_file_name.rsplit('.', 1)[0] + ".bin"
+
+
+# so is the listing / address map
+def listing_file_name(hack_file_name):
+    return hack_file_name.rsplit('.', 1)[0] + ".lst"
+
+
+# one tab separated listing record: ROM address, source line number, closest label above it, source text
+def listing_line(address, line_number, label, text):
+    return f"{address}\t{line_number}\t{label or '-'}\t{text}\n"
+
+
+# streams the listing sidecar: one record per ROM address written as it is assembled,
+# followed by the resolved symbol table (labels are ROM addresses, variables RAM addresses)
+# used to map addresses seen in an emulator back to the source
+class ListingWriter:
+    def __init__(self, file_name):
+        self.f = open(file_name, "w")
+        self.f.write("# rom\tline\tlabel\tsource\n")
+
+    def instruction(self, address, line_number, label, text):
+        self.f.write(listing_line(address, line_number, label, text))
+
+    # already formatted records (from a worker process)
+    def write(self, text):
+        self.f.write(text)
+
+    def symbols(self, labels, variables):
+        self.f.write("# labels\n")
+        for name, address in labels.items():
+            self.f.write(f"{name}\t{address}\n")
+        self.f.write("# variables\n")
+        for name, address in variables.items():
+            self.f.write(f"{name}\t{address}\n")
+
+    def close(self):
+        self.f.close()
+
+# writes words to a .hack file (and optionally a packed .bin image) in blocks as they are produced
+# every text line is 16 chars + newline and every packed word 2 bytes, so words that were
+# waiting on a forward label can be overwritten in place later on
+class HackWriter:
+    def __init__(self, file_name, binary_file_name=None, block_size=4096):
+        # binary mode so seek offsets are exact byte positions
+        self.text = open(file_name, "wb+")
+        self.binary = open(binary_file_name, "wb+") if binary_file_name else None
+        self.block_size = block_size
+        self.block = array('H')
+        # number of words already flushed to disk
+        self.count = 0
+
+    def append(self, word):
+        self.block.append(word)
+        if len(self.block) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.block:
+            return
+        text = render_text(self.block)
+        if self.count > 0:
+            text = '\n' + text
+        self.text.write(text.encode('ascii'))
+        if self.binary:
+            self.binary.write(words_to_bytes(self.block))
+        self.count += len(self.block)
+        self.block = array('H')
+
+    def patch(self, address, word):
+        if address >= self.count:
+            # still in the unflushed block
+            self.block[address - self.count] = word
+            return
+        self.text.seek(address * 17)
+        self.text.write(word_to_text(word).encode('ascii'))
+        self.text.seek(0, 2)
+        if self.binary:
+            self.binary.seek(address * 2)
+            self.binary.write(words_to_bytes([word]))
+            self.binary.seek(0, 2)
+
+    # lets the single pass assembler patch a writer the same way it patches an array
+    __setitem__ = patch
+
+    def close(self):
+        self.flush()
+        self.text.close()
+        if self.binary:
+            self.binary.close()
+
+
+"""
+purpose: assemble in one pass over the input, emitting each instruction as soon as it is read
+input: iterable of asm lines, output with append(word) and item assignment (an array or HackWriter)
+output: resolved symbol table
+A instructions that refer to a symbol not seen yet get a placeholder and their ROM address
+is recorded in a fixup table, which is patched once the whole input has been read.
+anything still unresolved at the end is a variable, given addresses from 16 up in order of first use
+"""
+def assemble_single_pass(lines, out, listing_writer=None):
+    symbols = dict(predefined_symbols)
+    labels = {}
+    # symbol -> ROM addresses of the A instructions waiting on it
+    fixups = {}
+    instruction_count = 0
+    current_label = None
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line[0] == '/':
+            continue
+
+        # is label
+        if '(' in line and ')' in line:
+            label = (line.split('(')[1]).split(')')[0]
+            symbols[label] = instruction_count
+            labels[label] = instruction_count
+            current_label = label
+            continue
+
+        if listing_writer:
+            listing_writer.instruction(instruction_count, line_number, current_label, line)
+
+        if line[0] == '@':
+            raw = line[1:]
+            if ord(raw[0]) >= 48 and ord(raw[0]) <= 57:
+                processed_line = a_instruction(raw)
+            elif raw in symbols:
+                processed_line = a_instruction(symbols[raw])
+            else:
+                # forward label or variable, don't know which yet
+                if raw not in fixups:
+                    fixups[raw] = array('L')
+                fixups[raw].append(instruction_count)
+                processed_line = 0
+        else:
+            processed_line = c_instruction(line)
+
+        out.append(processed_line)
+        instruction_count += 1
+
+    # backpatch: dict keeps first use order so variables get the same addresses as the two pass version
+    variables = {}
+    last_used_addr = 15
+    for raw, addresses in fixups.items():
+        if raw not in symbols:
+            symbols[raw] = last_used_addr + 1
+            variables[raw] = last_used_addr + 1
+            last_used_addr += 1
+        processed_line = a_instruction(symbols[raw])
+        for address in addresses:
+            out[address] = processed_line
+
+    if listing_writer:
+        listing_writer.symbols(labels, variables)
+
+    return symbols
+
+
+"""
+purpose: assemble a program held in memory, without touching the filesystem
+input: any iterable of asm lines (a list, a generator, an open file) or one string holding the whole program,
+       optional ListingWriter for an address map, whether to run the peephole optimizer first
+output: array('H') of machine words, ROM address i is words[i]
+"""
+def assemble(lines, listing_writer=None, optimize_code=False):
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    if optimize_code:
+        lines, _ = optimize(lines)
+    words = array('H')
+    assemble_single_pass(lines, words, listing_writer)
+    return words
+
+
+def main_single_pass(file, binary=False, listing=False, optimize_code=False):
     hack_file_name = str(file).split('.')[0] + "_answer" + ".hack"
-    with open(hack_file_name, "w") as f:
-        for i, line in enumerate(translation):
-            if i < len(translation)-1:
-                f.write(line + '\n')
+    out = HackWriter(hack_file_name, binary_file_name(hack_file_name) if binary else None)
+    listing_writer = ListingWriter(listing_file_name(hack_file_name)) if listing else None
+    lines = read_lines(file)
+    if optimize_code:
+        # the optimizer needs the whole program, so this gives up the constant memory
+        lines, removed = optimize(lines)
+        print(optimizer_message(removed))
+    try:
+        assemble_single_pass(lines, out, listing_writer)
+    finally:
+        out.close()
+        if listing_writer:
+            listing_writer.close()
+
+    return hack_file_name
+
+# splits the file into (file, start, end) byte ranges that each end on a line boundary
+def file_chunks(file, chunk_count):
+    size = os.path.getsize(file)
+    step = max(size // chunk_count, 1)
+    chunks = []
+    start = 0
+    with open(file, "rb") as f:
+        while start < size:
+            # finish the line that the step lands in
+            f.seek(min(start + step, size) - 1)
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((file, start, end))
+            start = end
+    return chunks
+
+
+def read_chunk(chunk):
+    file, start, end = chunk
+    with open(file, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return data.decode().split('\n')
+
+
+"""
+purpose: first parallel pass over one chunk
+input: (file, start, end) chunk
+output: [instruction count, {label: chunk local address}, symbols referenced in first use order,
+         number of newlines, last label seen in the chunk]
+"""
+def scan_chunk(chunk):
+    instruction_count = 0
+    labels = {}
+    references = {}
+    lines = read_chunk(chunk)
+    last_label = None
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] == '/':
+            continue
+
+        # is label
+        if '(' in line and ')' in line:
+            label = (line.split('(')[1]).split(')')[0]
+            labels[label] = instruction_count
+            last_label = label
+            continue
+
+        if line[0] == '@':
+            raw = line[1:]
+            if not (ord(raw[0]) >= 48 and ord(raw[0]) <= 57):
+                references[raw] = None
+        instruction_count += 1
+
+    return [instruction_count, labels, list(references), len(lines) - 1, last_label]
+
+
+"""
+purpose: second parallel pass, encode one chunk with the fully resolved symbol table
+input: [(file, start, end) chunk, symbols, None or [first ROM address, first line number, label in effect] for a listing]
+output: [text lines of the chunk joined with newlines, packed native uint16 words, listing records]
+"""
+def encode_chunk(args):
+    chunk, symbols, listing_start = args
+    translation = array('H')
+    listing = []
+    if listing_start:
+        base_address, first_line_number, current_label = listing_start
+    for line_number, line in enumerate(read_chunk(chunk)):
+        line = line.strip()
+        if not line or line[0] == '/':
+            continue
+        
+        # is label:
+        if '(' in line:
+            if listing_start:
+                current_label = (line.split('(')[1]).split(')')[0]
+            continue
+
+        if listing_start:
+            listing.append(listing_line(base_address + len(translation), first_line_number + line_number,
+                                        current_label, line))
+
+        if line[0] == '@':
+            raw = line[1:]
+            if ord(raw[0]) >= 48 and ord(raw[0]) <= 57:
+                translation.append(a_instruction(raw))
             else:
-                f.write(line)
-    
+                translation.append(a_instruction(symbols[raw]))
+        else:
+            translation.append(c_instruction(line))
+
+    return [render_text(translation), translation.tobytes(), ''.join(listing)]
+
+
+"""
+purpose: assemble a large file with a process pool, giving the same output as main()
+the file is split into line aligned chunks (a few per job). each chunk is scanned in parallel for
+its labels, instruction count and symbol references; labels are then offset by the instruction
+count of the chunks before them and variables are handed out in chunk order, which is the same
+first use order the serial version sees. finally the chunks are encoded in parallel and written in order
+"""
+def main_parallel(file, binary=False, jobs=2, listing=False):
+    chunks = file_chunks(file, jobs * 4)
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        scans = list(pool.map(scan_chunk, chunks))
+
+        symbols = dict(predefined_symbols)
+        all_labels = {}
+        # [first ROM address, first line number, label in effect] of each chunk, for the listing
+        listing_starts = []
+        base = 0
+        line_base = 1
+        current_label = None
+        for instruction_count, labels, _, newline_count, last_label in scans:
+            listing_starts.append([base, line_base, current_label] if listing else None)
+            for label, address in labels.items():
+                symbols[label] = base + address
+                all_labels[label] = base + address
+            base += instruction_count
+            line_base += newline_count
+            current_label = last_label or current_label
+
+        variables = {}
+        last_used_addr = 15
+        for scan in scans:
+            for raw in scan[2]:
+                if raw not in symbols:
+                    symbols[raw] = last_used_addr + 1
+                    variables[raw] = last_used_addr + 1
+                    last_used_addr += 1
+
+        hack_file_name = str(file).split('.')[0] + "_answer" + ".hack"
+        binary_file = open(binary_file_name(hack_file_name), "wb") if binary else None
+        listing_writer = ListingWriter(listing_file_name(hack_file_name)) if listing else None
+        try:
+            with open(hack_file_name, "w") as f:
+                written = 0
+                # map keeps chunk order, so results can be written as they come back
+                tasks = [(chunk, symbols, listing_start) for chunk, listing_start in zip(chunks, listing_starts)]
+                for (text, packed, listing_text), scan in zip(pool.map(encode_chunk, tasks), scans):
+                    if listing_writer:
+                        listing_writer.write(listing_text)
+                    if scan[0] == 0:
+                        continue
+                    if written > 0:
+                        f.write('\n')
+                    f.write(text)
+                    written += scan[0]
+                    if binary_file:
+                        words = array('H')
+                        words.frombytes(packed)
+                        binary_file.write(words_to_bytes(words))
+            if listing_writer:
+                listing_writer.symbols(all_labels, variables)
+        finally:
+            if binary_file:
+                binary_file.close()
+            if listing_writer:
+                listing_writer.close()
+
     return hack_file_name
 
-def check_answer(answer_file, file_to_check):
-    created_file_output = []
-    with open(file_to_check, "r") as f:
-        for line in f:
-            created_file_output.append(line)
 
-    answer = []
-    with open(answer_file, "r") as f:
-        for line in f:
-            answer.append(line)
-    
-    line_number = 0
-    matches = True
+# index of the first byte where a and b differ (a != b), found by bisecting on slice
+# equality so the search stays in C even for large blocks
+def first_difference(a, b):
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+"""
+purpose: compare two files and note differences
+input: two files, optional limit on how many differing lines to report, block size in bytes
+output: List [isMatching, [any errors/differences]]
+both files are streamed in large blocks that are compared as a whole while they line up byte for
+byte, only the lines around a difference are compared one by one. stops early after max_errors
+"""
+def check_answer(answer_file, file_to_check, max_errors=None, block_size=1 << 20):
     errors = []
-    while line_number < len(answer) and line_number < len(created_file_output):
-        if answer[line_number] != created_file_output[line_number]:
-            matches = False
-            errors.append("error on line: " + str(line_number+1))
-        line_number += 1
-    
-    if line_number > len(answer):
+    with open(answer_file, "rb") as answer, open(file_to_check, "rb") as created:
+        # number of lines already compared, and where the next line starts
+        line_number = 0
+        line_start = 0
+        answer_line = created_line = b''
+        while True:
+            answer_pos = answer.tell()
+            if answer_pos == created.tell():
+                answer_block = answer.read(block_size)
+                created_block = created.read(block_size)
+                if answer_block == created_block:
+                    if not answer_block:
+                        # both files ended together
+                        answer_line = created_line = b''
+                        break
+                    line_number += answer_block.count(b'\n')
+                    last_newline = answer_block.rfind(b'\n')
+                    if last_newline >= 0:
+                        line_start = answer_pos + last_newline + 1
+                    continue
+                # go back to the start of the line holding the first difference and compare by line
+                difference = first_difference(answer_block, created_block)
+                last_newline = answer_block.rfind(b'\n', 0, difference)
+                if last_newline >= 0:
+                    line_number += answer_block.count(b'\n', 0, difference)
+                    line_start = answer_pos + last_newline + 1
+                answer.seek(line_start)
+                created.seek(line_start)
+
+            answer_line = answer.readline()
+            created_line = created.readline()
+            if not answer_line or not created_line:
+                break
+            line_number += 1
+            line_start = answer.tell()
+            # same newline handling as comparing in text mode
+            if answer_line.replace(b'\r\n', b'\n') != created_line.replace(b'\r\n', b'\n'):
+                errors.append("error on line: " + str(line_number))
+                if max_errors is not None and len(errors) >= max_errors:
+                    errors.append(f"stopped after {max_errors} errors")
+                    return [False, errors]
+
+    if created_line and not answer_line:
         errors.append("output is too long")
-        matches = False
-    if line_number < len(answer):
+    if answer_line and not created_line:
         errors.append("output is too short")
-        matches = False
     
-    return [matches, errors]
+    return [len(errors) == 0, errors]
 
 if __name__ == "__main__":
-    created_hack_file = main(sys.argv[1])
-    if len(sys.argv) == 3:
-        result = check_answer(sys.argv[2], created_hack_file)
-        print(result)
+    parser = argparse.ArgumentParser(description="assemble a hack .asm file to <name>_answer.hack")
+    parser.add_argument("file", help=".asm file to assemble")
+    parser.add_argument("answer", nargs="?", help="optional .hack file to compare the result against")
+    parser.add_argument("--single-pass", action="store_true",
+                        help="stream the input once and backpatch forward labels (memory scales with symbols, not lines)")
+    parser.add_argument("--binary", action="store_true",
+                        help="also write a packed little endian uint16 image to <name>_answer.bin")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="assemble in N worker processes (output is identical to the serial path)")
+    parser.add_argument("--listing", action="store_true",
+                        help="also write <name>_answer.lst mapping each ROM address to its source line, plus the symbol table")
+    parser.add_argument("--optimize", action="store_true",
+                        help="run the peephole optimizer before encoding and report how many instructions it removed")
+    parser.add_argument("--max-errors", type=int, default=None,
+                        help="stop comparing against the answer file after N differing lines")
+    args = parser.parse_args()
 
-                
\ No newline at end of file
+    created_hack_file = main(args.file, single_pass=args.single_pass, binary=args.binary, jobs=args.jobs,
+                             listing=args.listing, optimize_code=args.optimize)
+    if args.answer:
+        result = check_answer(args.answer, created_hack_file, args.max_errors)
+        print(result)
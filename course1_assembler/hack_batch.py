@@ -0,0 +1,201 @@
+"""
+
+Lockstep batch emulator: many hack computers running the same program at once with NumPy
+PC, A and D are vectors with one entry per machine and RAM is a machines x 32K matrix. Every ROM word
+is decoded once into the control bits of the hack CPU (ALU zx/nx/zy/ny/f/no, dest, jump). A step
+gathers each machine's bits for its own PC and runs the ALU on all machines with masks, so machines
+whose PCs have diverged still all advance in the same step. Meant for fuzzing a program with many
+random seeds or keyboard inputs and looking at how every instance ended up
+
+usage: python hack_batch.py Pong.hack --machines 1000 --steps 100000 --randomize 0 --ram 0-4
+
+"""
+
+import time
+import argparse
+from hack_emulator import RAM_SIZE, KBD, load_words, decode_rom, parse_assignment, parse_addresses
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# columns of the decoded ROM flag table
+IS_C = 0
+A_BIT = 1
+ZX = 2
+NX = 3
+ZY = 4
+NY = 5
+F = 6
+NO = 7
+DEST_A = 8
+DEST_D = 9
+DEST_M = 10
+JLT = 11
+JEQ = 12
+JGT = 13
+HALT = 14
+FLAG_COUNT = 15
+
+# key codes --random-keys picks from: none, space, enter and the arrow keys
+RANDOM_KEYS = [0, 32, 128, 130, 131, 132, 133]
+
+
+"""
+purpose: decode a program for the batch emulator
+input: machine words
+output: [bool flag table (ROM size + 1) x FLAG_COUNT, int32 A instruction values]
+the extra last row stands for "past the end of ROM", where a machine halts. raises ValueError for
+words the single machine emulator can't decode either, so both run exactly the same programs
+"""
+def decode_batch_rom(words):
+    _, halts = decode_rom(words)
+    flags = np.zeros((len(words) + 1, FLAG_COUNT), dtype=bool)
+    values = np.zeros(len(words) + 1, dtype=np.int32)
+    for address, word in enumerate(words):
+        if not word & 0x8000:
+            values[address] = word
+            continue
+        # bits 12..0: a c1..c6 d1 d2 d3 j1 j2 j3, the c bits are the ALU's zx nx zy ny f no
+        for column, bit in ((IS_C, 15), (A_BIT, 12), (ZX, 11), (NX, 10), (ZY, 9), (NY, 8), (F, 7), (NO, 6),
+                            (DEST_A, 5), (DEST_D, 4), (DEST_M, 3), (JLT, 2), (JEQ, 1), (JGT, 0)):
+            flags[address, column] = bool(word >> bit & 1)
+        flags[address, HALT] = address in halts
+    return [flags, values]
+
+
+"""
+many hack computers running one program
+pc, a, d, steps: vectors with one entry per machine, ram: machines x RAM_SIZE int16 matrix,
+halted: bool vector, a machine stops when it reaches its end loop or runs off the end of ROM
+"""
+class BatchEmulator:
+    def __init__(self, words, machines):
+        if np is None:
+            raise ImportError("the batch emulator needs numpy installed")
+        self.flags, self.values = decode_batch_rom(words)
+        self.rom_size = len(words)
+        self.machines = machines
+        self.rows = np.arange(machines)
+        self.ram = np.zeros((machines, RAM_SIZE), dtype=np.int16)
+        self.reset()
+
+    @classmethod
+    def from_file(cls, file_name, machines):
+        return cls(load_words(file_name), machines)
+
+    # clears every machine's RAM and registers
+    def reset(self):
+        self.ram[:] = 0
+        # registers are kept as int32 holding signed 16 bit values, results are wrapped after the ALU
+        self.pc = np.zeros(self.machines, dtype=np.int32)
+        self.a = np.zeros(self.machines, dtype=np.int32)
+        self.d = np.zeros(self.machines, dtype=np.int32)
+        self.steps = np.zeros(self.machines, dtype=np.int64)
+        self.halted = np.zeros(self.machines, dtype=bool)
+
+    # the key each machine's keyboard reports, a vector or one key for all
+    def press(self, keys):
+        self.ram[:, KBD] = keys
+
+    # runs one instruction on every machine that hasn't halted
+    def step(self):
+        pc, a, d = self.pc, self.a, self.d
+        live = ~self.halted
+        flags = self.flags[pc]
+        c = flags[:, IS_C] & live
+
+        # ALU: x is D, y is A or M, each optionally zeroed and negated, then + or &, optionally negated
+        address = a & 0x7FFF
+        y = np.where(flags[:, A_BIT], self.ram[self.rows, address], a)
+        x = np.where(flags[:, ZX], 0, d)
+        x = np.where(flags[:, NX], ~x, x)
+        y = np.where(flags[:, ZY], 0, y)
+        y = np.where(flags[:, NY], ~y, y)
+        out = np.where(flags[:, F], x + y, x & y)
+        out = np.where(flags[:, NO], ~out, out)
+        out = ((out + 32768) & 0xFFFF) - 32768
+
+        # M is stored at A from before this instruction, like the jump goes there
+        store = c & flags[:, DEST_M]
+        self.ram[self.rows[store], address[store]] = out[store]
+        self.d = np.where(c & flags[:, DEST_D], out, d)
+        self.a = np.where(c & flags[:, DEST_A], out, np.where(live & ~flags[:, IS_C], self.values[pc], a))
+
+        taken = c & ((flags[:, JLT] & (out < 0)) | (flags[:, JEQ] & (out == 0)) | (flags[:, JGT] & (out > 0)))
+        # a target past the ROM goes to the extra row, which halts the machine
+        target = np.minimum(a & 0xFFFF, self.rom_size)
+        self.pc = np.where(taken, target, pc + live)
+        self.steps += live
+        self.halted |= (taken & flags[:, HALT]) | (self.pc == self.rom_size)
+
+    """
+    purpose: run every machine
+    input: most instructions to run per machine
+    output: number of steps taken, fewer than max_steps if every machine halted
+    """
+    def run(self, max_steps):
+        for step in range(max_steps):
+            if self.halted.all():
+                return step
+            self.step()
+        return max_steps
+
+    # one line per machine: its state and the given RAM words
+    def report(self, addresses=()):
+        lines = []
+        for machine in range(self.machines):
+            state = 'halted' if self.halted[machine] else 'running'
+            words = ' '.join(f'RAM[{address}]={self.ram[machine, address]}' for address in addresses)
+            lines.append(f'{machine:>6} {state:<8} steps={self.steps[machine]} PC={self.pc[machine]} '
+                         f'A={self.a[machine]} D={self.d[machine]} {words}'.rstrip())
+        return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run many copies of a hack program in lockstep with numpy")
+    parser.add_argument("file", help=".hack or .bin file from hack_assembler.py")
+    parser.add_argument("--machines", type=int, default=100, help="number of machines (default 100)")
+    parser.add_argument("--steps", type=int, default=100000, help="most instructions per machine (default 100000)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random values and keys (default 0)")
+    parser.add_argument("--set", action="append", default=[], metavar="ADDR=VALUE",
+                        help="set a RAM word of every machine before running")
+    parser.add_argument("--randomize", action="append", default=[], type=int, metavar="ADDR",
+                        help="set a RAM word to a different random value on every machine")
+    parser.add_argument("--random-keys", type=int, default=0, metavar="N",
+                        help="every N instructions give each machine a random key (arrows, space, enter or none)")
+    parser.add_argument("--ram", action="append", default=[], metavar="ADDR[-ADDR]",
+                        help="RAM words to report for every machine")
+    args = parser.parse_args()
+
+    if np is None:
+        parser.error("the batch emulator needs numpy installed")
+    try:
+        batch = BatchEmulator.from_file(args.file, args.machines)
+    except ValueError as error:
+        parser.error(str(error))
+    rng = np.random.default_rng(args.seed)
+    for assignment in args.set:
+        address, value = parse_assignment(assignment)
+        batch.ram[:, address] = value
+    for address in args.randomize:
+        batch.ram[:, address] = rng.integers(-32768, 32768, args.machines)
+
+    start = time.perf_counter()
+    interval = args.random_keys or args.steps
+    steps = 0
+    while steps < args.steps:
+        if args.random_keys:
+            batch.press(rng.choice(RANDOM_KEYS, args.machines))
+        ran = batch.run(min(interval, args.steps - steps))
+        steps += ran
+        if ran < interval:
+            break
+    elapsed = time.perf_counter() - start
+    total = int(batch.steps.sum())
+    print(f"{args.machines} machines, {int(batch.halted.sum())} halted, {total} instructions in {elapsed:.3f}s "
+          f"({total / max(elapsed, 1e-9) / 1e6:.2f}M per second)")
+    addresses = [address for text in args.ram for address in parse_addresses(text)]
+    for line in batch.report(addresses):
+        print(line)
@@ -0,0 +1,445 @@
+"""
+
+Hack CPU emulator for the output of hack_assembler.py
+Loads a text .hack file or a packed .bin image and decodes every ROM word once into a
+(comp, dest, jump) tuple: comp is the function computing the ALU output, dest the 3 bit mask of the
+registers it is stored in and jump the condition table, so running an instruction never looks at
+bits again. RAM is a 32K array('h') (or a NumPy int16 buffer) with the screen and keyboard
+memory mapped at SCREEN/KBD, the same addresses as the assembler's symbols
+With --recompile, straight runs of instructions (basic blocks) are translated once into Python
+functions that update A, D and RAM directly, which saves the dispatch per instruction
+
+usage: python hack_emulator.py Pong.hack --steps 10000000 --ram 0-15 [--recompile [--check]]
+
+"""
+
+import sys
+import copy
+import time
+import argparse
+from array import array
+from hack_assembler import comp_dict, predefined_symbols
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RAM_SIZE = 32768
+SCREEN = predefined_symbols['SCREEN']
+KBD = predefined_symbols['KBD']
+SCREEN_SIZE = KBD - SCREEN
+
+
+# wraps a result back into a signed 16 bit word
+def to_word(value):
+    return ((value + 32768) & 0xFFFF) - 32768
+
+
+# ALU functions of (A, D, RAM), one per comp mnemonic of the assembler. M reads RAM[A]:
+# A holds a signed word and a negative index wraps around the 32K RAM, the same as taking its low 15 bits
+COMP_FUNCTIONS = {
+    "0": lambda a, d, ram: 0,
+    "1": lambda a, d, ram: 1,
+    "-1": lambda a, d, ram: -1,
+    "D": lambda a, d, ram: d,
+    "A": lambda a, d, ram: a,
+    "M": lambda a, d, ram: ram[a],
+    "!D": lambda a, d, ram: ~d,
+    "!A": lambda a, d, ram: ~a,
+    "!M": lambda a, d, ram: ~ram[a],
+    "-D": lambda a, d, ram: to_word(-d),
+    "-A": lambda a, d, ram: to_word(-a),
+    "-M": lambda a, d, ram: to_word(-ram[a]),
+    "D+1": lambda a, d, ram: to_word(d + 1),
+    "A+1": lambda a, d, ram: to_word(a + 1),
+    "M+1": lambda a, d, ram: to_word(ram[a] + 1),
+    "D-1": lambda a, d, ram: to_word(d - 1),
+    "A-1": lambda a, d, ram: to_word(a - 1),
+    "M-1": lambda a, d, ram: to_word(ram[a] - 1),
+    "D+A": lambda a, d, ram: to_word(d + a),
+    "D+M": lambda a, d, ram: to_word(d + ram[a]),
+    "D-A": lambda a, d, ram: to_word(d - a),
+    "D-M": lambda a, d, ram: to_word(d - ram[a]),
+    "A-D": lambda a, d, ram: to_word(a - d),
+    "M-D": lambda a, d, ram: to_word(ram[a] - d),
+    "D&A": lambda a, d, ram: d & a,
+    "D&M": lambda a, d, ram: d & ram[a],
+    "D|A": lambda a, d, ram: d | a,
+    "D|M": lambda a, d, ram: d | ram[a],
+}
+
+# comp bits (a bit included) -> [mnemonic, function]
+COMP_CODES = {bits: [comp, COMP_FUNCTIONS[comp]] for comp, bits in comp_dict.items()}
+
+# dest bits
+DEST_M = 0b001
+DEST_D = 0b010
+DEST_A = 0b100
+
+# jump bits -> whether it is taken, indexed by the sign of the ALU output: [zero, positive, negative]
+# (so table[(out > 0) - (out < 0)]), None for no jump
+JUMP_TABLES = [None] + [(bool(jump & 0b010), bool(jump & 0b001), bool(jump & 0b100)) for jump in range(1, 8)]
+JUMP_ALWAYS = 0b111
+
+
+"""
+purpose: decode one machine word
+input: 16 bit word, its ROM address (for the error message)
+output: (comp function, dest mask, jump table) for a C instruction,
+        (None, value, None) for an A instruction
+raises ValueError for comp bits the assembler never produces
+"""
+def decode_word(word, address=0):
+    if not word & 0x8000:
+        return (None, word, None)
+    comp = (word >> 6) & 0x7F
+    if comp not in COMP_CODES:
+        raise ValueError(f"ROM[{address}]: {word:016b} has no known comp bits")
+    return (COMP_CODES[comp][1], (word >> 3) & 0b111, JUMP_TABLES[word & 0b111])
+
+
+"""
+purpose: decode a whole program
+input: machine words
+output: [list of decoded instructions, set of halt addresses]
+equal words share one tuple. a halt address is the 0;JMP of an "(END) @END 0;JMP" loop, the usual
+way a hack program stops
+"""
+def decode_rom(words):
+    decoded = {}
+    rom = []
+    for address, word in enumerate(words):
+        if word not in decoded:
+            decoded[word] = decode_word(word, address)
+        rom.append(decoded[word])
+    halts = set()
+    for address in range(1, len(words)):
+        comp, dest, jump = rom[address]
+        if comp is not None and not dest and jump is JUMP_TABLES[JUMP_ALWAYS] and words[address - 1] == address - 1:
+            halts.add(address)
+    return [rom, halts]
+
+
+"""
+purpose: read the machine words of a program
+input: path to a text .hack file (one 16 character binary line per word) or a packed little
+       endian uint16 .bin image, as written by hack_assembler.py
+output: array('H') of words
+"""
+def load_words(file_name):
+    words = array('H')
+    if file_name.endswith('.bin'):
+        with open(file_name, 'rb') as f:
+            words.frombytes(f.read())
+        if sys.byteorder == 'big':
+            words.byteswap()
+    else:
+        with open(file_name, 'r') as f:
+            words.extend(int(line, 2) for line in map(str.strip, f) if line)
+    return words
+
+
+# longest block compiled as one function, a longer straight run is split
+BLOCK_LIMIT = 1024
+
+# jump bits -> python condition on the ALU output
+JUMP_SOURCE = {
+    0b001: 'out > 0',
+    0b010: 'out == 0',
+    0b011: 'out >= 0',
+    0b100: 'out < 0',
+    0b101: 'out != 0',
+    0b110: 'out <= 0',
+}
+
+
+# python expression for a comp mnemonic, A written as {a} and M as {m}
+def comp_template(comp):
+    expression = comp.replace('!', '~').replace('A', '{a}').replace('M', '{m}').replace('D', 'd')
+    if comp != '-1' and ('+' in comp or '-' in comp):
+        # same wrap as to_word
+        expression = f'((({expression}) + 32768) & 0xFFFF) - 32768'
+    return expression
+
+
+COMP_TEMPLATES = {bits: comp_template(comp) for bits, (comp, _) in COMP_CODES.items()}
+
+
+"""
+purpose: python source of the basic block starting at an address
+input: machine words, halt addresses (from decode_rom), start address
+output: [source of "def block(ram, a, d)" returning (a, d, next pc), number of instructions, whether
+        it ends in a halt]
+a block runs up to and including the first jump (or to the end of ROM, or BLOCK_LIMIT instructions).
+A values loaded by @value are kept as constants while compiling, so RAM accesses through them become
+fixed indexes and the register is only assigned when it is computed
+"""
+def block_source(words, halts, start):
+    lines = ['def block(ram, a, d):']
+    # source of the current A: a literal while it is known, else the variable
+    a = 'a'
+    address = start
+    end = min(len(words), start + BLOCK_LIMIT)
+    next_pc = None
+    ends_in_halt = False
+    while address < end:
+        word = words[address]
+        address += 1
+        if not word & 0x8000:
+            a = str(word)
+            continue
+        comp = (word >> 6) & 0x7F
+        if comp not in COMP_CODES:
+            raise ValueError(f"ROM[{address - 1}]: {word:016b} has no known comp bits")
+        expression = COMP_TEMPLATES[comp].format(a=a, m=f'ram[{a}]')
+        dest, jump = (word >> 3) & 0b111, word & 0b111
+        targets = []
+        if dest & DEST_M:
+            targets.append(f'ram[{a}]')
+        if dest & DEST_D:
+            targets.append('d')
+        if jump and jump != JUMP_ALWAYS:
+            targets.append('out')
+        # the jump goes to A from before this instruction
+        target = a
+        if dest & DEST_A:
+            if jump and a == 'a':
+                lines.append('    target = a')
+                target = 'target'
+            targets.append('a')
+            a = 'a'
+        if targets:
+            lines.append(f'    {" = ".join(targets)} = {expression}')
+        if jump:
+            # a negative word is an address past 32K, outside any ROM
+            destination = target if target.isdigit() else f'{target} & 0xFFFF'
+            if jump == JUMP_ALWAYS:
+                next_pc = destination
+                ends_in_halt = address - 1 in halts
+            else:
+                next_pc = f'({destination}) if {JUMP_SOURCE[jump]} else {address}'
+            break
+    if next_pc is None:
+        next_pc = str(address)
+    lines.append(f'    return {a}, d, {next_pc}')
+    return ['\n'.join(lines) + '\n', address - start, ends_in_halt]
+
+
+# the compiled function of block_source, with the code object it came from
+def compile_block(source, start):
+    code = compile(source, f'<hack block {start}>', 'exec')
+    namespace = {}
+    exec(code, namespace)
+    return [namespace['block'], code]
+
+
+# RAM contents compared byte for byte, for either backend
+def same_ram(x, y):
+    return memoryview(x).cast('B') == memoryview(y).cast('B')
+
+
+# zeroed RAM, array('h') or a NumPy int16 array
+def new_ram(use_numpy=False):
+    if use_numpy:
+        if np is None:
+            raise ImportError("the NumPy RAM needs numpy installed")
+        return np.zeros(RAM_SIZE, dtype=np.int16)
+    return array('h', bytes(2 * RAM_SIZE))
+
+
+"""
+hack computer running one program
+ram: 32K signed words, a, d, pc: the registers, steps: instructions run so far,
+halted: the program reached its end loop or ran off the end of ROM
+"""
+class HackEmulator:
+    def __init__(self, words, use_numpy=False):
+        self.rom, self.halts = decode_rom(words)
+        self.use_numpy = use_numpy
+        self.ram = new_ram(use_numpy)
+        self.words = words
+        # start address -> [function, number of instructions, ends in a halt], filled as blocks are reached
+        self.blocks = {}
+        self.reset()
+
+    @classmethod
+    def from_file(cls, file_name, use_numpy=False):
+        return cls(load_words(file_name), use_numpy)
+
+    # clears RAM and the registers
+    def reset(self):
+        self.ram[:] = new_ram(self.use_numpy)
+        self.a = self.d = self.pc = 0
+        self.steps = 0
+        self.halted = False
+
+    # the key the keyboard reports (0 for none)
+    def press(self, key):
+        self.ram[KBD] = key
+
+    # the screen's words, 32 per row of 512 pixels
+    def screen(self):
+        return self.ram[SCREEN:KBD]
+
+    """
+    purpose: run the program
+    input: most instructions to run
+    output: number of instructions run, fewer than max_steps if the program halted
+    """
+    def run(self, max_steps):
+        rom = self.rom
+        halts = self.halts
+        # works for both backends, indexing it gives and takes plain ints
+        ram = memoryview(self.ram)
+        a, d, pc = self.a, self.d, self.pc
+        step = 0
+        try:
+            while step < max_steps:
+                comp, dest, jump = rom[pc]
+                step += 1
+                if comp is None:
+                    # @value
+                    a = dest
+                    pc += 1
+                    continue
+                out = comp(a, d, ram)
+                # the jump goes to A as it was before this instruction stores anything
+                target = a
+                if dest:
+                    if dest & DEST_M:
+                        ram[a] = out
+                    if dest & DEST_D:
+                        d = out
+                    if dest & DEST_A:
+                        a = out
+                if jump is not None and jump[(out > 0) - (out < 0)]:
+                    if pc in halts:
+                        self.halted = True
+                        pc = target
+                        break
+                    # a negative word is an address past 32K, outside any ROM
+                    pc = target & 0xFFFF
+                else:
+                    pc += 1
+        except IndexError:
+            # ran off the end of the program, the failed fetch wasn't counted
+            self.halted = True
+        finally:
+            self.a, self.d, self.pc = a, d, pc
+            self.steps += step
+        return step
+
+    # an emulator in the same state with its own RAM, the decoded ROM and compiled blocks are shared
+    def clone(self):
+        other = copy.copy(self)
+        other.ram = copy.copy(self.ram)
+        return other
+
+    # the compiled block starting at pc, compiled the first time it is reached
+    def block_at(self, pc):
+        if pc not in self.blocks:
+            source, length, halts = block_source(self.words, self.halts, pc)
+            self.blocks[pc] = [compile_block(source, pc)[0], length, halts]
+        return self.blocks[pc]
+
+    """
+    purpose: run the program a basic block at a time, each block as a compiled python function
+    input: most instructions to run, whether to check every block against the interpreter
+    output: number of instructions run, fewer than max_steps if the program halted
+    gives the same results as run(). the last instructions before max_steps that don't make up a whole
+    block are interpreted. checking runs a clone of the emulator on run() next to it and raises
+    RuntimeError at the first block after which the registers or RAM differ
+    """
+    def run_compiled(self, max_steps, check=False):
+        shadow = self.clone() if check else None
+        ram = memoryview(self.ram)
+        blocks = self.blocks
+        rom_size = len(self.rom)
+        a, d, pc = self.a, self.d, self.pc
+        step = 0
+        try:
+            while True:
+                if pc >= rom_size:
+                    # ran off the end of the program
+                    self.halted = True
+                    break
+                block = blocks[pc] if pc in blocks else self.block_at(pc)
+                function, length, halts = block
+                if step + length > max_steps:
+                    break
+                start = pc
+                a, d, pc = function(ram, a, d)
+                step += length
+                if shadow is not None:
+                    shadow.run(length)
+                    if (a, d, pc) != (shadow.a, shadow.d, shadow.pc) or not same_ram(self.ram, shadow.ram):
+                        raise RuntimeError(f"block at {start}: A, D, PC = {a}, {d}, {pc}, "
+                                           f"interpreter has {shadow.a}, {shadow.d}, {shadow.pc} "
+                                           f"or different RAM")
+                if halts:
+                    self.halted = True
+                    break
+        finally:
+            self.a, self.d, self.pc = a, d, pc
+            self.steps += step
+        if not self.halted and step < max_steps:
+            step += self.run(max_steps - step)
+        return step
+
+
+# "ADDR=VALUE" -> [address, value]
+def parse_assignment(text):
+    address, value = text.split('=')
+    return [int(address), int(value)]
+
+
+# "ADDR" or "FIRST-LAST" -> range of addresses
+def parse_addresses(text):
+    first, _, last = text.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run a hack .hack or packed .bin program")
+    parser.add_argument("file", help=".hack or .bin file from hack_assembler.py")
+    parser.add_argument("--steps", type=int, default=10000000, help="most instructions to run (default 10000000)")
+    parser.add_argument("--set", action="append", default=[], metavar="ADDR=VALUE",
+                        help="set a RAM word before running")
+    parser.add_argument("--key", type=int, default=0, help="key code held down on the keyboard while running")
+    parser.add_argument("--ram", action="append", default=[], metavar="ADDR[-ADDR]",
+                        help="print RAM words after running")
+    parser.add_argument("--numpy", action="store_true", help="keep RAM in a NumPy int16 array")
+    parser.add_argument("--recompile", action="store_true",
+                        help="run basic blocks compiled to python functions instead of interpreting")
+    parser.add_argument("--check", action="store_true",
+                        help="with --recompile, check every block against the interpreter (slow)")
+    args = parser.parse_args()
+
+    if args.numpy and np is None:
+        parser.error("--numpy needs numpy installed")
+    try:
+        emulator = HackEmulator.from_file(args.file, args.numpy)
+    except ValueError as error:
+        parser.error(str(error))
+    for assignment in args.set:
+        address, value = parse_assignment(assignment)
+        emulator.ram[address] = value
+    emulator.press(args.key)
+
+    start = time.perf_counter()
+    try:
+        if args.recompile:
+            steps = emulator.run_compiled(args.steps, args.check)
+        else:
+            steps = emulator.run(args.steps)
+    except RuntimeError as error:
+        print(f"error: {error}")
+        steps = emulator.steps
+    elapsed = time.perf_counter() - start
+    state = 'halted' if emulator.halted else 'stopped'
+    print(f"{state} after {steps} instructions in {elapsed:.3f}s ({steps / max(elapsed, 1e-9) / 1e6:.2f}M per second)")
+    print(f"A = {emulator.a}, D = {emulator.d}, PC = {emulator.pc}")
+    for text in args.ram:
+        for address in parse_addresses(text):
+            print(f"RAM[{address}] = {emulator.ram[address]}")
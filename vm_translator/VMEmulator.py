@@ -0,0 +1,392 @@
+"""
+
+Purpose of this file is to run '.vm' programs directly, without translating and assembling them
+The commands are parsed the same way the translator reads them (readVmCommands), then resolved once
+into integer instructions: labels and functions become program indexes, temps and statics become
+RAM addresses. run() executes them in a single dispatch loop over a preallocated RAM list
+
+"""
+
+import os
+import time
+import argparse
+from helper import *
+
+RAM_SIZE = 32768
+# first address the translated code would give a static variable
+STATIC_BASE = 16
+STACK_BASE = 256
+
+# emulator opcodes, every vm command is resolved to one of these
+# (operands: x, y of the instruction tuple)
+PUSH_CONSTANT = 0   # x = value
+PUSH_LOCAL = 1      # x = index
+PUSH_ARGUMENT = 2
+PUSH_THIS = 3
+PUSH_THAT = 4
+PUSH_ADDRESS = 5    # temp and static, x = RAM address
+PUSH_POINTER = 6    # x = 0 (THIS) or 1 (THAT)
+POP_LOCAL = 7
+POP_ARGUMENT = 8
+POP_THIS = 9
+POP_THAT = 10
+POP_ADDRESS = 11
+POP_POINTER = 12
+ADD = 13
+SUB = 14
+NEG = 15
+EQ = 16
+GT = 17
+LT = 18
+AND = 19
+OR = 20
+NOT = 21
+GOTO = 22           # x = instruction index
+IF_GOTO = 23
+FUNCTION = 24       # x = number of locals
+CALL = 25           # x = instruction index of the function, y = nArgs
+RETURN = 26
+HALT = 27           # the end of the program, and where Sys.init returns to
+ERROR = 28          # a line that isn't a vm command, raises when it is reached
+
+# segment -> [push opcode, pop opcode] for the segments read through a base pointer
+SEGMENT_CODES = {
+    'local': [PUSH_LOCAL, POP_LOCAL],
+    'argument': [PUSH_ARGUMENT, POP_ARGUMENT],
+    'this': [PUSH_THIS, POP_THIS],
+    'that': [PUSH_THAT, POP_THAT],
+}
+
+# vm commands without operands
+ARITHMETIC_CODES = {
+    Op.ADD: ADD,
+    Op.SUB: SUB,
+    Op.NEG: NEG,
+    Op.EQ: EQ,
+    Op.GT: GT,
+    Op.LT: LT,
+    Op.AND: AND,
+    Op.OR: OR,
+    Op.NOT: NOT,
+    Op.RETURN: RETURN,
+}
+
+
+# the .vm files of a program: the file itself, or every .vm file of a directory in the translator's order
+def vmFilePaths(inputPath):
+    if os.path.isdir(inputPath):
+        return [os.path.join(inputPath, fileName) for fileName in sorted(os.listdir(inputPath))
+                if fileName.endswith(".vm")]
+    return [inputPath]
+
+
+"""
+purpose: resolve a program's vm commands into emulator instructions
+input: dict file name -> parsed vm commands, in program order
+output: [list of (opcode, x, y) tuples ending with HALT, list of (file name, vm command) per instruction,
+        dict function name -> instruction index]
+labels take no instruction, they resolve to the index of the command after them. lines that aren't vm
+commands become ERROR (the translator turns them into a comment, the emulator stops if one is reached).
+raises ValueError for jumps and calls to labels or functions that aren't defined
+"""
+def resolveProgram(programs):
+    # first pass: where every label and function ends up
+    labels = {}
+    functions = {}
+    source = []
+    for fileName, commands in programs.items():
+        currentFunction = None
+        for command in commands:
+            if command.op == Op.LABEL:
+                labels[scopedLabel(command.name, currentFunction)] = len(source)
+                continue
+            if command.op == Op.FUNCTION:
+                currentFunction = command.name
+                functions[command.name] = len(source)
+            source.append((fileName, command, currentFunction))
+
+    # second pass: the instructions, with every name replaced by an index or address
+    program = []
+    statics = {}
+    for fileName, command, currentFunction in source:
+        op = command.op
+        if op in ARITHMETIC_CODES:
+            program.append((ARITHMETIC_CODES[op], 0, 0))
+        elif op in MEMORY_OPS:
+            program.append(resolveMemory(fileName, command, statics))
+        elif op == Op.GOTO or op == Op.IF_GOTO:
+            label = scopedLabel(command.name, currentFunction)
+            if label not in labels:
+                raise ValueError(f'{fileName}: {command}: label {label} is not defined')
+            program.append((GOTO if op == Op.GOTO else IF_GOTO, labels[label], 0))
+        elif op == Op.FUNCTION:
+            program.append((FUNCTION, command.arg, 0))
+        elif op == Op.CALL:
+            if command.name not in functions:
+                raise ValueError(f'{fileName}: {command}: function {command.name} is not defined')
+            program.append((CALL, functions[command.name], command.arg))
+        elif op == Op.UNKNOWN:
+            program.append((ERROR, 0, 0))
+        else:
+            raise ValueError(f'{fileName}: {command}: not a vm command the emulator can run')
+    program.append((HALT, 0, 0))
+    return [program, [(fileName, command) for fileName, command, _ in source], functions]
+
+
+# the instruction for a push/pop, statics get addresses in order of first use like the assembler's variables
+def resolveMemory(fileName, command, statics):
+    push = command.op == Op.PUSH
+    segment, index = command.segment, command.arg
+    if segment == 'constant' and push:
+        return (PUSH_CONSTANT, index, 0)
+    if segment in SEGMENT_CODES:
+        return (SEGMENT_CODES[segment][0 if push else 1], index, 0)
+    if segment == 'temp' and index < 8:
+        address = 5 + index
+    elif segment == 'static':
+        address = statics.setdefault((command.name or fileName, index), STATIC_BASE + len(statics))
+    elif segment == 'pointer' and index in pointer_keyword:
+        return (PUSH_POINTER if push else POP_POINTER, index, 0)
+    else:
+        raise ValueError(f'{fileName}: {command}: bad segment or index')
+    return (PUSH_ADDRESS if push else POP_ADDRESS, address, 0)
+
+
+"""
+vm machine running one program
+ram: list of RAM_SIZE values (16 bit, signed), pc: index of the next instruction, steps: commands run
+SP, LCL, ARG, THIS and THAT live in RAM[0..4] between calls to run, inside it they are kept in local
+variables (a program reading or writing RAM[0..4] through a pointer won't see or change them)
+"""
+class VmEmulator:
+    def __init__(self, programs):
+        self.program, self.source, self.functions = resolveProgram(programs)
+        self.ram = [0] * RAM_SIZE
+        self.reset()
+
+    # loads every .vm file of inputPath
+    @classmethod
+    def fromPath(cls, inputPath):
+        return cls({os.path.basename(filePath).split(".")[0]: list(readVmCommands(filePath))
+                    for filePath in vmFilePaths(inputPath)})
+
+    # clears RAM and starts over: with Sys.init the bootstrap calls it (like the translated code),
+    # otherwise execution starts at the first command with SP = 256
+    def reset(self):
+        ram = self.ram
+        ram[:] = [0] * RAM_SIZE
+        self.steps = 0
+        ram[0] = STACK_BASE
+        self.pc = 0
+        if 'Sys.init' in self.functions:
+            # call Sys.init 0, returning to the HALT at the end: frame of zero pointers at 256,
+            # SP = LCL = 261, ARG = 256
+            ram[STACK_BASE] = len(self.program) - 1
+            ram[0:3] = [STACK_BASE + 5, STACK_BASE + 5, STACK_BASE]
+            self.pc = self.functions['Sys.init']
+
+    # true at the HALT ending the program, or after a return to an address outside it
+    @property
+    def halted(self):
+        return not 0 <= self.pc < len(self.program) - 1
+
+    # the file and vm command of instruction pc
+    def commandAt(self, pc):
+        return self.source[pc] if pc < len(self.source) else ('end of program', 'halt')
+
+    """
+    purpose: run the program
+    input: most commands to run
+    output: number of commands run, fewer than maxSteps if the program halted
+    raises RuntimeError if the stack or a pointer runs off the end of RAM, or on a line that isn't a vm command
+    """
+    def run(self, maxSteps):
+        ram = self.ram
+        program = self.program
+        pc = self.pc
+        sp, lcl, arg, this, that = ram[0:5]
+        step = 0
+        try:
+            # ordered by how often the commands run in compiled jack code
+            while step < maxSteps:
+                code, x, y = program[pc]
+                pc += 1
+                step += 1
+                if code == PUSH_CONSTANT:
+                    ram[sp] = x
+                    sp += 1
+                elif code == PUSH_LOCAL:
+                    ram[sp] = ram[lcl + x]
+                    sp += 1
+                elif code == PUSH_ARGUMENT:
+                    ram[sp] = ram[arg + x]
+                    sp += 1
+                elif code == POP_LOCAL:
+                    sp -= 1
+                    ram[lcl + x] = ram[sp]
+                elif code == ADD:
+                    sp -= 1
+                    value = ram[sp - 1] + ram[sp]
+                    if value > 32767:
+                        value -= 65536
+                    elif value < -32768:
+                        value += 65536
+                    ram[sp - 1] = value
+                elif code == IF_GOTO:
+                    sp -= 1
+                    if ram[sp]:
+                        pc = x
+                elif code == NOT:
+                    ram[sp - 1] = ~ram[sp - 1]
+                elif code == GOTO:
+                    pc = x
+                elif code == PUSH_THAT:
+                    ram[sp] = ram[that + x]
+                    sp += 1
+                elif code == POP_POINTER:
+                    sp -= 1
+                    if x:
+                        that = ram[sp]
+                    else:
+                        this = ram[sp]
+                elif code == PUSH_THIS:
+                    ram[sp] = ram[this + x]
+                    sp += 1
+                elif code == POP_THIS:
+                    sp -= 1
+                    ram[this + x] = ram[sp]
+                elif code == LT:
+                    sp -= 1
+                    ram[sp - 1] = -1 if ram[sp - 1] < ram[sp] else 0
+                elif code == GT:
+                    sp -= 1
+                    ram[sp - 1] = -1 if ram[sp - 1] > ram[sp] else 0
+                elif code == EQ:
+                    sp -= 1
+                    ram[sp - 1] = -1 if ram[sp - 1] == ram[sp] else 0
+                elif code == PUSH_ADDRESS:
+                    ram[sp] = ram[x]
+                    sp += 1
+                elif code == POP_ADDRESS:
+                    sp -= 1
+                    ram[x] = ram[sp]
+                elif code == POP_THAT:
+                    sp -= 1
+                    ram[that + x] = ram[sp]
+                elif code == SUB:
+                    sp -= 1
+                    value = ram[sp - 1] - ram[sp]
+                    if value > 32767:
+                        value -= 65536
+                    elif value < -32768:
+                        value += 65536
+                    ram[sp - 1] = value
+                elif code == CALL:
+                    # save the caller's frame, ARG = SP - 5 - nArgs, LCL = SP
+                    ram[sp] = pc
+                    ram[sp + 1] = lcl
+                    ram[sp + 2] = arg
+                    ram[sp + 3] = this
+                    ram[sp + 4] = that
+                    sp += 5
+                    arg = sp - 5 - y
+                    lcl = sp
+                    pc = x
+                elif code == FUNCTION:
+                    for i in range(x):
+                        ram[sp + i] = 0
+                    sp += x
+                elif code == RETURN:
+                    frame = lcl
+                    pc = ram[frame - 5]
+                    ram[arg] = ram[sp - 1]
+                    sp = arg + 1
+                    that = ram[frame - 1]
+                    this = ram[frame - 2]
+                    arg = ram[frame - 3]
+                    lcl = ram[frame - 4]
+                elif code == PUSH_POINTER:
+                    ram[sp] = that if x else this
+                    sp += 1
+                elif code == POP_ARGUMENT:
+                    sp -= 1
+                    ram[arg + x] = ram[sp]
+                elif code == NEG:
+                    value = -ram[sp - 1]
+                    ram[sp - 1] = -32768 if value == 32768 else value
+                elif code == AND:
+                    sp -= 1
+                    ram[sp - 1] &= ram[sp]
+                elif code == OR:
+                    sp -= 1
+                    ram[sp - 1] |= ram[sp]
+                elif code == ERROR:
+                    pc -= 1
+                    step -= 1
+                    fileName, command = self.commandAt(pc)
+                    raise RuntimeError(f'{fileName}: {command}: not a vm command')
+                else:
+                    # HALT, stay on it
+                    pc -= 1
+                    step -= 1
+                    break
+        except IndexError:
+            if not 0 <= pc < len(program):
+                # fetching failed: a return to an address that isn't an instruction
+                raise RuntimeError(f'jumped to {pc}, outside the program') from None
+            # the failing command already counted as run
+            pc -= 1
+            fileName, command = self.commandAt(pc)
+            raise RuntimeError(f'{fileName}: {command}: address out of RAM (SP={sp})') from None
+        finally:
+            ram[0:5] = [sp, lcl, arg, this, that]
+            self.pc = pc
+            self.steps += step
+        return step
+
+
+# "ADDR=VALUE" -> [address, value]
+def parseAssignment(text):
+    address, value = text.split('=')
+    return [int(address), int(value)]
+
+
+# "ADDR" or "FIRST-LAST" -> range of addresses
+def parseAddresses(text):
+    first, _, last = text.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run a .vm file or a directory of .vm files")
+    parser.add_argument("inputPath", help=".vm file or directory")
+    parser.add_argument("--steps", type=int, default=1000000, help="most vm commands to run (default 1000000)")
+    parser.add_argument("--set", action="append", default=[], metavar="ADDR=VALUE",
+                        help="set a RAM word before running, eg. the segment pointers of a test")
+    parser.add_argument("--ram", action="append", default=[], metavar="ADDR[-ADDR]",
+                        help="print RAM words after running")
+    args = parser.parse_args()
+
+    try:
+        emulator = VmEmulator.fromPath(args.inputPath)
+    except ValueError as error:
+        parser.error(str(error))
+    for assignment in args.set:
+        address, value = parseAssignment(assignment)
+        emulator.ram[address] = value
+
+    start = time.perf_counter()
+    try:
+        emulator.run(args.steps)
+    except RuntimeError as error:
+        print(f'error: {error}')
+    elapsed = time.perf_counter() - start
+    steps = emulator.steps
+    state = 'halted' if emulator.halted else 'stopped'
+    print(f'{state} after {steps} vm commands in {elapsed:.3f}s '
+          f'({steps / max(elapsed * 1000, 1e-9):.0f} per ms)')
+    fileName, command = emulator.commandAt(emulator.pc)
+    print(f'next command: {fileName}: {command}')
+    for text in args.ram:
+        for address in parseAddresses(text):
+            print(f'RAM[{address}] = {emulator.ram[address]}')
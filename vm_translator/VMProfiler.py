@@ -0,0 +1,218 @@
+"""
+
+Purpose of this file is to find where a '.vm' program spends its time
+The program is run on VmEmulator one basic block at a time. Every function gets its calls, the vm
+commands it ran and its exclusive/inclusive cost, where a command costs the number of hack
+instructions translateVMtoASM emits for it. Prints a table sorted by cost and can write the cost per
+call stack in the collapsed format flamegraph tools read ("Sys.init;Main.main;Math.multiply 1234")
+
+"""
+
+import time
+import argparse
+from helper import *
+from VMEmulator import VmEmulator, parseAssignment, GOTO, IF_GOTO, CALL, RETURN, HALT, ERROR
+
+# instructions that end a basic block
+BLOCK_END_CODES = frozenset([GOTO, IF_GOTO, CALL, RETURN, HALT, ERROR])
+
+
+# number of asm instructions in a translation (labels and comments take no ROM)
+def asmInstructionCount(lines):
+    return sum(1 for line in lines if not line.startswith('(') and not line.startswith('//'))
+
+
+"""
+purpose: what each emulator instruction belongs to and costs
+input: VmEmulator, VmCmdLookup the costs are taken from
+output: [function name per instruction, cost per instruction]
+commands before the first function of a file (test scripts without functions) belong to the file
+"""
+def instructionCosts(emulator, Vmlookup):
+    functionNames = []
+    costs = []
+    currentFile = currentFunction = None
+    for fileName, command in emulator.source:
+        if fileName != currentFile:
+            currentFile, currentFunction = fileName, None
+        if command.op == Op.FUNCTION:
+            currentFunction = command.name
+        functionNames.append(currentFunction or fileName)
+        costs.append(asmInstructionCount(translateVMtoASM(command, Vmlookup, 0, currentFunction, 0, fileName)))
+    # the HALT at the end
+    functionNames.append(None)
+    costs.append(0)
+    return [functionNames, costs]
+
+
+"""
+purpose: split a program into basic blocks
+input: emulator program (list of instruction tuples)
+output: list of how many instructions run from each index to the end of its block
+a block starts at every jump target, function and return address and ends after a jump, call or return,
+so once the emulator is at an index the next length instructions always run in a row
+"""
+def blockLengths(program):
+    starts = {0}
+    for pc, (code, x, y) in enumerate(program):
+        if code in BLOCK_END_CODES:
+            starts.add(pc + 1)
+        if code == GOTO or code == IF_GOTO or code == CALL:
+            starts.add(x)
+    lengths = [0] * len(program)
+    length = 0
+    for pc in range(len(program) - 1, -1, -1):
+        length = 1 if pc + 1 in starts or program[pc][0] in BLOCK_END_CODES else length + 1
+        lengths[pc] = length
+    return lengths
+
+
+"""
+function statistics gathered by profile()
+calls, commands: vm commands run in the function itself, exclusive: their cost,
+inclusive: cost from entering the function until it returned (recursive calls counted once)
+"""
+class FunctionProfile:
+    __slots__ = ('name', 'calls', 'commands', 'exclusive', 'inclusive')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.commands = 0
+        self.exclusive = 0
+        self.inclusive = 0
+
+
+"""
+purpose: run a program under the profiler
+input: VmEmulator (as it is, eg. after reset() and setting RAM), most vm commands to run, optional
+       VmCmdLookup the costs are taken from (default translation options)
+output: [dict function name -> FunctionProfile, dict collapsed call stack -> cost, total cost,
+        error message or None]
+stops when the program halts, after maxSteps commands or when the emulator raises RuntimeError (the
+statistics then cover every command before the one that failed)
+"""
+def profile(emulator, maxSteps, Vmlookup=None):
+    functionNames, costs = instructionCosts(emulator, Vmlookup or VmCmdLookup())
+    program = emulator.program
+    lengths = blockLengths(program)
+    # cost of the instructions from each index to the end of its block
+    blockCosts = costs[:]
+    for pc in range(len(program) - 2, -1, -1):
+        if lengths[pc] > 1:
+            blockCosts[pc] += blockCosts[pc + 1]
+
+    profiles = {}
+    stacks = {}
+    total = 0
+
+    def functionProfile(name):
+        if name not in profiles:
+            profiles[name] = FunctionProfile(name)
+        return profiles[name]
+
+    def enter(name):
+        functionProfile(name).calls += 1
+        onStack[name] = onStack.get(name, 0) + 1
+        frames.append([name, total, f'{frames[-1][2]};{name}' if frames else name])
+
+    def leave():
+        name, entryCost, _ = frames.pop()
+        onStack[name] -= 1
+        if not onStack[name]:
+            # outermost call of the function, the inner ones are already inside this one
+            profiles[name].inclusive += total - entryCost
+
+    # [function, total cost when it was entered, collapsed stack]
+    frames = []
+    onStack = {}
+    if not emulator.halted:
+        enter(functionNames[emulator.pc])
+    run = emulator.run
+    error = None
+    while emulator.steps < maxSteps and not emulator.halted:
+        pc = emulator.pc
+        length = lengths[pc]
+        steps = emulator.steps
+        try:
+            run(min(length, maxSteps - steps))
+        except RuntimeError as runError:
+            error = str(runError)
+        done = emulator.steps - steps
+        if not done:
+            break
+        # the rest of the block didn't run when it was cut short
+        cost = blockCosts[pc] - (blockCosts[pc + done] if done < length else 0)
+        total += cost
+        stacks[frames[-1][2]] = stacks.get(frames[-1][2], 0) + cost
+        function = functionProfile(functionNames[pc])
+        function.commands += done
+        function.exclusive += cost
+        if done < length:
+            break
+
+        code = program[pc + length - 1][0]
+        if code == CALL:
+            enter(functionNames[emulator.pc])
+        elif code == RETURN:
+            leave()
+            if not frames and not emulator.halted:
+                # returned out of the code profiling started in (a test without a caller)
+                enter(functionNames[emulator.pc])
+    # functions still running count up to now
+    while frames:
+        leave()
+    return [profiles, stacks, total, error]
+
+
+# table rows, most expensive first
+def profileTable(profiles, total, key='exclusive', top=None):
+    rows = sorted(profiles.values(), key=lambda function: getattr(function, key), reverse=True)[:top]
+    lines = [f'{"function":<32} {"calls":>9} {"commands":>12} {"exclusive":>12} {"%":>6} {"inclusive":>12} {"%":>6}']
+    for function in rows:
+        lines.append(f'{function.name:<32} {function.calls:>9} {function.commands:>12} '
+                     f'{function.exclusive:>12} {100 * function.exclusive / max(total, 1):>6.1f} '
+                     f'{function.inclusive:>12} {100 * function.inclusive / max(total, 1):>6.1f}')
+    return lines
+
+
+# writes "stack cost" lines for flamegraph.pl, speedscope and the like
+def writeCollapsedStacks(stacks, fileName):
+    with open(fileName, 'w') as f:
+        for stack, cost in sorted(stacks.items()):
+            if cost:
+                f.write(f'{stack} {cost}\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="profile a .vm file or a directory of .vm files per function")
+    parser.add_argument("inputPath", help=".vm file or directory")
+    parser.add_argument("--steps", type=int, default=1000000, help="most vm commands to run (default 1000000)")
+    parser.add_argument("--set", action="append", default=[], metavar="ADDR=VALUE",
+                        help="set a RAM word before running, eg. the segment pointers of a test")
+    parser.add_argument("--sort", choices=["exclusive", "inclusive", "calls", "commands"], default="exclusive",
+                        help="column the table is sorted by (default exclusive)")
+    parser.add_argument("--top", type=int, metavar="N", help="only print the N most expensive functions")
+    parser.add_argument("--collapsed", metavar="FILE", help="write the cost per call stack to FILE for flamegraphs")
+    args = parser.parse_args()
+
+    try:
+        emulator = VmEmulator.fromPath(args.inputPath)
+    except ValueError as error:
+        parser.error(str(error))
+    for assignment in args.set:
+        address, value = parseAssignment(assignment)
+        emulator.ram[address] = value
+
+    start = time.perf_counter()
+    profiles, stacks, total, error = profile(emulator, args.steps)
+    if error:
+        print(f'error: {error}')
+    elapsed = time.perf_counter() - start
+    state = 'halted' if emulator.halted else 'stopped'
+    print(f'{state} after {emulator.steps} vm commands in {elapsed:.3f}s, cost {total} hack instructions')
+    for line in profileTable(profiles, total, args.sort, args.top):
+        print(line)
+    if args.collapsed:
+        writeCollapsedStacks(stacks, args.collapsed)
+        print(f'collapsed stacks written to: {args.collapsed}')
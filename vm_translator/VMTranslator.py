@@ -7,92 +7,273 @@ Optional argument is test file to compare asm result file
 
 import sys
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from helper import *
 
-def translateFile(filePath):
-    # read in raw line by line input
-    raw_input = readRawInputFile(filePath)
-    # print(raw_input)
+# adds the command counts of one file to the running totals
+def addCounts(totals, counts):
+    for command, count in counts.items():
+        totals[command] = totals.get(command, 0) + count
 
-    # clean raw input to remove empty lines & comments
-    cleaned_input = cleanRawInput(raw_input)
-    # print(cleaned_input)    
 
-    # go through cleaned input and translare to asm
-    translated_asm = []
-    VmLookupObj = VmCmdLookup()
-    funcLabel = None
+# name a .vm file's statics and labels are qualified with
+def vmFileName(filePath):
+    return os.path.basename(filePath).split(".")[0]
+
+
+"""
+purpose: translate one .vm file
+input: path to the .vm file, translation options (keyword arguments of VmCmdLookup), optional dict
+       that counts how many times each vm command was translated (peephole hits are counted in it
+       too, under ('peephole', pattern name) keys and inlined calls under ('inline', function name)),
+       optional set of the functions to keep (the bodies of the others are dropped), optional
+       functions to inline (from inlineCandidates)
+output: generator of asm lines, produced as each vm command is translated
+every stage (reading, cleaning, parsing, the optimizer passes, translating) is a generator pulling
+one command at a time from the one before, so memory use doesn't depend on the file's length.
+the counts are added to commandCounts once the last line has been produced
+"""
+def translateFileLines(filePath, options=None, commandCounts=None, liveFunctions=None, inlineFunctions=None):
+    # read, clean (remove empty lines & comments) and parse line by line
+    commands = readVmCommands(filePath)
+
+    fileName = vmFileName(filePath)
+    # same order as the whole program analysis: inline, then drop what is unreachable
+    inlineHits = {}
+    if inlineFunctions:
+        commands = inlineCalls(commands, inlineFunctions, fileName, inlineHits)
+    if liveFunctions is not None:
+        commands = removeDeadFunctions(commands, liveFunctions)
+
+    # go through the commands and translare to asm
+    VmLookupObj = VmCmdLookup(**(options or {}))
+    matchers = []
+    if VmLookupObj.peephole:
+        matchers.append(matchPeephole)
+    if VmLookupObj.fuseBranches:
+        matchers.append(matchFusedBranch)
+    peepholeHits = {}
+    if matchers:
+        commands = peepholeOptimize(commands, peepholeHits, matchers)
+    funcName = None
     call_counter = 0
-    fileName = os.path.basename(filePath).split(".")[0]
+    # commands translated per opcode
+    counts = [0] * (Op.UNKNOWN + 1)
+    translate = translateCachedVMtoASM if VmLookupObj.cacheTop else translateVMtoASM
     # print(fileName)
-    for i, line in enumerate(cleaned_input):
-        if isComment(line):
-            continue
-        else:
-            asm_eqv = []
-            command = '// ' + str(line)
-            asm_eqv.append(command)
-
-            split_cmd = line.split(' ')
-
-            # save/create function label here? and pass to obj?
-            if split_cmd[0] == 'function':
-                funcLabel = f'{split_cmd[1]}$ret{i}'
-                # print(funcLabel)
-            if split_cmd[0] == 'call':
+    for i, command in enumerate(commands):
+        yield '// ' + command.text
+
+        op = command.op
+        # labels inside a function are scoped to it
+        if op in NAMED_OPS:
+            if op == Op.FUNCTION:
+                funcName = command.name
+            else:
                 call_counter += 1
+        counts[op] += 1
+
+        yield from translate(command, VmLookupObj, i, funcName, call_counter, fileName)
+
+    # the cached top of stack has to be in memory when the file's code ends
+    yield from flushTop(VmLookupObj)
+
+    if commandCounts is not None:
+        # reported per command name
+        addCounts(commandCounts, {OP_TEXT.get(op, 'error'): count for op, count in enumerate(counts) if count})
+        addCounts(commandCounts, {('inline', name): count for name, count in inlineHits.items()})
+        addCounts(commandCounts, {('peephole', name): count for name, count in peepholeHits.items()})
+
+
+# translates one .vm file to a list of asm lines
+def translateFile(filePath, options=None):
+    return list(translateFileLines(filePath, options))
+
+
+# translates one .vm file to a single block of asm text and its command counts,
+# what worker processes send back
+def translateFileText(filePath, options=None, liveFunctions=None, inlineFunctions=None):
+    commandCounts = {}
+    text = '\n'.join(translateFileLines(filePath, options, commandCounts, liveFunctions, inlineFunctions))
+    return [text, commandCounts]
+
+
+# prints the ('peephole', name) or ('inline', name) counts, most hits first
+def printHits(commandCounts, kind, title):
+    hits = [(count, key[1]) for key, count in commandCounts.items() if isinstance(key, tuple) and key[0] == kind]
+    print(title)
+    for count, name in sorted(hits, reverse=True):
+        print(f'{count:>8}  {name}')
+
+
+"""
+purpose: find the functions of a program that can't be reached from Sys.init
+input: parsed vm commands of each file (after inlining, if it's on)
+output: [set of functions to keep, list of removed function names, vm commands removed]
+        the set is None when there is no Sys.init to start from
+"""
+def findDeadFunctions(programs):
+    calls, sizes = callGraph(programs)
+    liveFunctions = reachableFunctions(calls)
+    if liveFunctions is None:
+        return [None, [], 0]
+    removed = sorted(name for name in sizes if name not in liveFunctions)
+    return [liveFunctions, removed, sum(sizes[name] for name in removed)]
+
+
+"""
+purpose: translate a directory's files into writer, reusing cached translations of unchanged files
+input: writer, .vm paths (in output order), cache directory, translation options, dict the command
+       counts are added to, whole program pass results, number of worker processes
+output: none
+the missing files are translated (in a pool if jobs > 1) and stored, then every file's asm is
+written in the given order, cached or not, so the output is the same as without the cache
+"""
+def translateCached(writer, filePaths, cacheDir, options, commandCounts, liveFunctions, inlineFunctions, jobs):
+    version = translatorVersion()
+    keys = [cacheKey(filePath, version, options, liveFunctions, inlineFunctions) for filePath in filePaths]
+    pieces = [loadCachedTranslation(cacheDir, key) for key in keys]
+    missing = [i for i, piece in enumerate(pieces) if piece is None]
+    missingPaths = [filePaths[i] for i in missing]
+    extraArgs = [[options] * len(missing), [liveFunctions] * len(missing), [inlineFunctions] * len(missing)]
+    if jobs > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(translateFileText, missingPaths, *extraArgs))
+    else:
+        results = list(map(translateFileText, missingPaths, *extraArgs))
+    for i, (text, counts) in zip(missing, results):
+        storeCachedTranslation(cacheDir, keys[i], vmFileName(filePaths[i]), text, counts)
+        pieces[i] = [text, counts]
+        print(f'Translated file at: {filePaths[i]}')
+
+    for text, counts in pieces:
+        writer.writeText(text)
+        addCounts(commandCounts, counts)
+    print(f'cache: reused {len(filePaths) - len(missing)} of {len(filePaths)} files')
 
-            tmp = translateVMtoASM(split_cmd, VmLookupObj, i, funcLabel, call_counter, fileName)
-            asm_eqv.extend(tmp)
-            translated_asm.append(asm_eqv)
-    # print(translated_asm)
-    # flatten asm
-    flattened_asm = flattenArr(translated_asm)
-    # print(flattened_asm)
-    
-    return flattened_asm
 
 if __name__ == "__main__":
-    inputPath = sys.argv[1]
-    
-    bootstrap_arr = writeBoostrapASM()
+    parser = argparse.ArgumentParser(description="translate a .vm file or a directory of .vm files to hack .asm")
+    parser.add_argument("inputPath", help=".vm file or directory")
+    parser.add_argument("answer", nargs="?", help="optional .asm file to compare a single file's result against")
+    parser.add_argument("--jobs", type=int, default=1, help="translate the files of a directory in N worker processes")
+    parser.add_argument("--shared-calls", action="store_true",
+                        help="call/return jump to one shared routine each instead of being inlined (directory mode)")
+    parser.add_argument("--comparisons", choices=["inline", "shared"],
+                        help="eq/gt/lt inlined (default) or jumping to shared subroutines (directory mode), "
+                             "either way the size/cycle tradeoff is reported")
+    parser.add_argument("--peephole", action="store_true",
+                        help="rewrite common vm command windows into shorter ones before translating")
+    parser.add_argument("--fuse-branches", action="store_true",
+                        help="translate eq/gt/lt followed by if-goto (optionally negated) as one subtract and jump")
+    parser.add_argument("--cache-top", action="store_true",
+                        help="keep the top of stack in D between commands instead of storing and reloading it")
+    parser.add_argument("--remove-dead", action="store_true",
+                        help="drop functions that can't be reached from Sys.init (directory mode)")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="reuse translations of unchanged .vm files from DIR (directory mode)")
+    parser.add_argument("--inline", type=int, default=0, metavar="N",
+                        help="inline functions of at most N vm commands that make no calls at their call sites")
+    args = parser.parse_args()
+    inputPath = args.inputPath
 
-    if os.path.isfile(inputPath):
-        # translate single file to asm string arr
-        # each item is single line of asm translation
-        asm_arr = translateFile(inputPath)
+    options = {'sharedCalls': args.shared_calls, 'sharedComparisons': args.comparisons == 'shared',
+               'peephole': args.peephole, 'fuseBranches': args.fuse_branches, 'cacheTop': args.cache_top}
+    if (args.shared_calls or args.comparisons == 'shared') and not os.path.isdir(inputPath):
+        # the routines are placed after the bootstrap, which only directories get
+        parser.error("--shared-calls and --comparisons shared need a directory input")
+    if args.cache and not os.path.isdir(inputPath):
+        parser.error("--cache needs a directory input")
+    if args.remove_dead and not os.path.isdir(inputPath):
+        # a single file has no Sys.init bootstrap to start the reachability search from
+        parser.error("--remove-dead needs a directory input")
+    if args.jobs > 1 and not os.path.isdir(inputPath):
+        # files are what gets spread over the workers
+        parser.error("--jobs needs a directory input")
+    bootstrap_arr = writeBoostrapASM(VmCmdLookup(**options))
+    commandCounts = {}
 
-        # write array to file line by line
+    if os.path.isfile(inputPath):
         ogFileName = os.path.basename(inputPath)
         outputFileName = str(ogFileName.split('.')[0])+ '.' + 'asm'
-        # write .vm translated .asm data to file
-        writeListToFile(asm_arr, outputFileName, 0)
+        # translate straight into the output file, line by line
+        inlineFunctions = None
+        if args.inline:
+            inlineFunctions = inlineCandidates({vmFileName(inputPath): list(readVmCommands(inputPath))},
+                                               args.inline)
+        with AsmWriter(outputFileName) as writer:
+            writer.writeLines(translateFileLines(inputPath, options, commandCounts, None, inlineFunctions))
 
-        if len(sys.argv) == 3:
-            result = check_answer(sys.argv[2], outputFileName)
+        if args.inline:
+            printHits(commandCounts, 'inline', 'inlined calls:')
+        if args.peephole or args.fuse_branches:
+            printHits(commandCounts, 'peephole', 'peephole hits:')
+
+        if args.answer:
+            result = check_answer(args.answer, outputFileName)
             print(result)
     elif os.path.isdir(inputPath): 
         # translate directory and compile
-        asm_arrs = []
-        for i, fileName in enumerate(os.listdir(inputPath)):
-            if fileName.endswith(".vm"):
-                filePath = os.path.join(inputPath, fileName)
-                print(f'Translating file at: {filePath}')
-                asm_arrs.append(translateFile(filePath))
-                print(f'Done Translating file at: {filePath}')
-        
         dirNameStr = os.path.basename(os.path.normpath(inputPath))
-        # print(dirNameStr)
-        # print(inputPath)
         outputFileName = f'{dirNameStr}.asm'
-        # fullOutputPath = f'{inputPath}{outputFileName}'
         fullOutputPath = os.path.join(inputPath, outputFileName)
         print(f'Writing results to file: {fullOutputPath}')
-        
-        # write bootstrap to file:
-        writeListToFile(bootstrap_arr, fullOutputPath, 0)
-        for idx, arr in enumerate(asm_arrs):
-            writeListToFile(arr, fullOutputPath, idx+1)
+
+        # sorted so the output is the same on every machine (listdir order is arbitrary)
+        filePaths = [os.path.join(inputPath, fileName) for fileName in sorted(os.listdir(inputPath))
+                     if fileName.endswith(".vm")]
+
+        liveFunctions = None
+        inlineFunctions = None
+        if args.inline or args.remove_dead:
+            # whole program passes, every file is read up front
+            programs = {vmFileName(filePath): list(readVmCommands(filePath)) for filePath in filePaths}
+            if args.inline:
+                inlineFunctions = inlineCandidates(programs, args.inline)
+                programs = {fileName: list(inlineCalls(commands, inlineFunctions, fileName))
+                            for fileName, commands in programs.items()}
+        if args.remove_dead:
+            liveFunctions, removed, removedCommands = findDeadFunctions(programs.values())
+            if liveFunctions is None:
+                print('no Sys.init, keeping every function')
+            else:
+                print(f'removed {len(removed)} unreachable functions ({removedCommands} vm commands):')
+                for name in removed:
+                    print(f'    {name}')
+
+        # one writer for the whole program, each file is translated straight into it
+        with AsmWriter(fullOutputPath) as writer:
+            # write bootstrap to file:
+            writer.writeLines(bootstrap_arr)
+            if args.cache:
+                translateCached(writer, filePaths, args.cache, options, commandCounts, liveFunctions,
+                                inlineFunctions, args.jobs)
+            elif args.jobs > 1:
+                # files are independent, translate them in a pool and write the results in sorted order
+                with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+                    results = pool.map(translateFileText, filePaths, [options] * len(filePaths),
+                                       [liveFunctions] * len(filePaths), [inlineFunctions] * len(filePaths))
+                    for filePath, (text, counts) in zip(filePaths, results):
+                        writer.writeText(text)
+                        addCounts(commandCounts, counts)
+                        print(f'Done Translating file at: {filePath}')
+            else:
+                for filePath in filePaths:
+                    print(f'Translating file at: {filePath}')
+                    writer.writeLines(translateFileLines(filePath, options, commandCounts, liveFunctions,
+                                                         inlineFunctions))
+                    print(f'Done Translating file at: {filePath}')
         print(f'Done writing results to file: {fullOutputPath}')
+        if args.shared_calls:
+            for line in sharedCallReport(commandCounts, VmCmdLookup(**options)):
+                print(line)
+        if args.comparisons:
+            for line in comparisonReport(commandCounts, VmCmdLookup(**options)):
+                print(line)
+        if args.inline:
+            printHits(commandCounts, 'inline', 'inlined calls:')
+        if args.peephole or args.fuse_branches:
+            printHits(commandCounts, 'peephole', 'peephole hits:')
     else:
         print("input args error")
@@ -1 +1,4 @@
-from .helper import *
\ No newline at end of file
+from .ir import *
+from .helper import *
+from .optimizer import *
+from .cache import *
\ No newline at end of file
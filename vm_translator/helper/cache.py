@@ -0,0 +1,116 @@
+"""
+
+Incremental translation cache for directory mode
+
+Every .vm file is translated on its own (statics, comparison labels and return address labels all
+carry the file name, and the call counter starts over in each file), so one file's asm only
+depends on its own contents and the translator. Entries are keyed by a hash of those and stored
+as one JSON file each in the cache directory
+
+"""
+
+import os
+import json
+import hashlib
+from .helper import cleanLines
+from .ir import Op, parseCommands
+
+HELPER_DIR = os.path.dirname(os.path.abspath(__file__))
+TRANSLATOR_DIR = os.path.dirname(HELPER_DIR)
+
+
+"""
+purpose: version of the translator, so entries made by older code are never reused
+input: none
+output: hex digest of VMTranslator.py and every helper module
+"""
+def translatorVersion():
+    digest = hashlib.sha256()
+    paths = [os.path.join(TRANSLATOR_DIR, 'VMTranslator.py')]
+    paths += sorted(os.path.join(HELPER_DIR, name) for name in os.listdir(HELPER_DIR) if name.endswith('.py'))
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+"""
+purpose: cache key of one .vm file's translation
+input: path to the .vm file, translator version, translation options, the whole program passes'
+       results (set of live functions, inline candidates, either may be None)
+output: hex digest
+the whole program passes only enter the key through the parts this file uses: which of its own
+functions are live and the bodies of the functions it calls that get inlined
+"""
+def cacheKey(filePath, version, options, liveFunctions=None, inlineFunctions=None):
+    with open(filePath, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256()
+    digest.update(version.encode())
+    digest.update(os.path.basename(filePath).encode())
+    digest.update(content)
+    digest.update(json.dumps(options or {}, sort_keys=True).encode())
+    if liveFunctions is not None or inlineFunctions:
+        commands = list(parseCommands(cleanLines(content.decode().splitlines())))
+        if liveFunctions is not None:
+            defined = [command.name for command in commands if command.op == Op.FUNCTION]
+            digest.update(json.dumps([[name, name in liveFunctions] for name in defined]).encode())
+        if inlineFunctions:
+            called = sorted({command.name for command in commands if command.op == Op.CALL})
+            digest.update(json.dumps([[name, candidateJson(inlineFunctions.get(name))] for name in called]).encode())
+    return digest.hexdigest()
+
+
+# inline candidate with its body as vm text, None stays None
+def candidateJson(candidate):
+    if candidate is None:
+        return None
+    fileName, nLocals, body, pointers = candidate
+    return [fileName, nLocals, [str(command) for command in body], pointers]
+
+
+# tuple keys (('peephole', name), ('inline', name)) don't survive JSON, they are stored as lists
+def encodeCounts(commandCounts):
+    return [[list(key) if isinstance(key, tuple) else key, count] for key, count in commandCounts.items()]
+
+
+def decodeCounts(entries):
+    return {tuple(key) if isinstance(key, list) else key: count for key, count in entries}
+
+
+"""
+purpose: look up a translation
+input: cache directory, key from cacheKey
+output: [asm text, command counts] or None if it isn't cached
+"""
+def loadCachedTranslation(cacheDir, key):
+    path = os.path.join(cacheDir, f'{key}.json')
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+        return [entry['asm'], decodeCounts(entry['commandCounts'])]
+    except (ValueError, KeyError, TypeError):
+        # a broken entry (bad JSON, missing fields, wrong shape) is a miss, it gets rewritten
+        return None
+
+
+"""
+purpose: store a translation
+input: cache directory, key from cacheKey, name of the .vm file, asm text, command counts
+output: none
+written to a temp file and renamed into place, so an interrupted build never leaves half an entry
+"""
+def storeCachedTranslation(cacheDir, key, fileName, text, commandCounts):
+    os.makedirs(cacheDir, exist_ok=True)
+    entry = {
+        'file': fileName,
+        'commandCounts': encodeCounts(commandCounts),
+        'asm': text,
+    }
+    path = os.path.join(cacheDir, f'{key}.json')
+    tmpPath = f'{path}.{os.getpid()}.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmpPath, path)
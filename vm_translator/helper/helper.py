@@ -1,15 +1,20 @@
+from operator import itemgetter, methodcaller
+from .ir import *
+
+
 """
 purpose: read in text from file line by line -> put in array
 input: file name
 output: array containing each line of input file
 """
 def readRawInputFile(input_file):
-    raw_input = []
+    return list(readRawLines(input_file))
+
+
+# yields the lines of a file one at a time, the file is never held in memory as a whole
+def readRawLines(input_file):
     with open(input_file, "r") as f:
-        for line in f:
-            raw_input.append(line)
-    
-    return raw_input
+        yield from f
 
 
 """
@@ -18,58 +23,97 @@ input: array of raw line by line text from file
 output: array without empty lines and with comments/whitespace removed
 """
 def cleanRawInput(raw_input_arr):
-    cleaned_input = []
-    for line in raw_input_arr:        
-        line = line.strip()
-        if not line or isComment(line):
-            continue
-        # check for inline comments and remove
-        # remove tabs
-        line = line.replace('\t', '')
-        # remove anything after comment symbol
-        line = line.split('/')[0]
-        # remove trailing spaces
-        line = line.rstrip()
-        # append cleaned line
-        cleaned_input.append(line)
-
-    return cleaned_input
+    return list(cleanLines(raw_input_arr))
+
+
+# cleanRawInput one line at a time, takes any iterable of lines (eg. readRawLines)
+# built from map/filter only so no python code runs per line: stripping and cutting at the first '/'
+# leaves comment and empty lines empty, filter drops those
+def cleanLines(raw_lines):
+    lines = map(str.strip, raw_lines)
+    # remove tabs
+    lines = map(methodcaller('replace', '\t', ''), lines)
+    # remove anything after comment symbol
+    lines = map(itemgetter(0), map(methodcaller('partition', '/'), lines))
+    # remove trailing spaces, skip what is left empty
+    return filter(None, map(str.rstrip, lines))
+
+
+# parsed commands of a .vm file, read, cleaned and parsed lazily
+def readVmCommands(input_file):
+    return parseCommands(cleanLines(readRawLines(input_file)))
+
+
+# index of the first byte where a and b differ (a != b), found by bisecting on slice
+# equality so the search stays in C even for large blocks
+def firstDifference(a, b):
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
 
 
 """
 purpose: compare two files and note differences
-input: two files
+input: two files, optional limit on how many differing lines to report, block size in bytes
 output: List [isMatching, [any errors/differences]]
-
+both files are streamed in large blocks that are compared as a whole while they line up byte for
+byte, only the lines around a difference are compared one by one. stops early after max_errors
 """
-def check_answer(answer_file, file_to_check):
-    created_file_output = []
-    with open(file_to_check, "r") as f:
-        for line in f:
-            created_file_output.append(line)
-
-    answer = []
-    with open(answer_file, "r") as f:
-        for line in f:
-            answer.append(line)
-    
-    line_number = 0
-    matches = True
+def check_answer(answer_file, file_to_check, max_errors=None, block_size=1 << 20):
     errors = []
-    while line_number < len(answer) and line_number < len(created_file_output):
-        if answer[line_number] != created_file_output[line_number]:
-            matches = False
-            errors.append("error on line: " + str(line_number+1))
-        line_number += 1
-    
-    if line_number > len(answer):
+    with open(answer_file, "rb") as answer, open(file_to_check, "rb") as created:
+        # number of lines already compared, and where the next line starts
+        line_number = 0
+        line_start = 0
+        answer_line = created_line = b''
+        while True:
+            answer_pos = answer.tell()
+            if answer_pos == created.tell():
+                answer_block = answer.read(block_size)
+                created_block = created.read(block_size)
+                if answer_block == created_block:
+                    if not answer_block:
+                        # both files ended together
+                        answer_line = created_line = b''
+                        break
+                    line_number += answer_block.count(b'\n')
+                    last_newline = answer_block.rfind(b'\n')
+                    if last_newline >= 0:
+                        line_start = answer_pos + last_newline + 1
+                    continue
+                # go back to the start of the line holding the first difference and compare by line
+                difference = firstDifference(answer_block, created_block)
+                last_newline = answer_block.rfind(b'\n', 0, difference)
+                if last_newline >= 0:
+                    line_number += answer_block.count(b'\n', 0, difference)
+                    line_start = answer_pos + last_newline + 1
+                answer.seek(line_start)
+                created.seek(line_start)
+
+            answer_line = answer.readline()
+            created_line = created.readline()
+            if not answer_line or not created_line:
+                break
+            line_number += 1
+            line_start = answer.tell()
+            # same newline handling as comparing in text mode
+            if answer_line.replace(b'\r\n', b'\n') != created_line.replace(b'\r\n', b'\n'):
+                errors.append("error on line: " + str(line_number))
+                if max_errors is not None and len(errors) >= max_errors:
+                    errors.append(f"stopped after {max_errors} errors")
+                    return [False, errors]
+
+    if created_line and not answer_line:
         errors.append("output is too long")
-        matches = False
-    if line_number < len(answer):
+    if answer_line and not created_line:
         errors.append("output is too short")
-        matches = False
     
-    return [matches, errors]
+    return [len(errors) == 0, errors]
 
 # returns true if line is a comment
 def isComment(line):
@@ -78,9 +122,88 @@ def isComment(line):
     else:
         return False
 
+# placeholders used in the templates and the f-string each one is compiled to
+TEMPLATE_FIELDS = {
+    # comparison labels carry the file name so every file's output stands on its own
+    '@T_N': "f'@T_{fileName}_{n}'",
+    '(T_N)': "f'(T_{fileName}_{n})'",
+    '@END_N': "f'@END_{fileName}_{n}'",
+    '(END_N)': "f'(END_{fileName}_{n})'",
+    '@RET_N': "f'@RET_{fileName}_{n}'",
+    '(RET_N)': "f'(RET_{fileName}_{n})'",
+    '(LABEL)': "f'({label})'",
+    '@_LABEL': "f'@{label}'",
+    '@_NAME': "f'@{label}'",
+    '@segment': "f'@{segment}'",
+    '@seg_idx': "f'@{index}'",
+    '@fileName.seg_idx': "f'@{fileName}.{index}'",
+    '(funcName)': "f'({funcName})'",
+    '@funcName': "f'@{funcName}'",
+    '@nArgs': "f'@{nArgs}'",
+    '@retAddrLabel': "f'@{retAddrLabel}'",
+    '(retAddrLabel)': "f'({retAddrLabel})'",
+}
+
+# every compiled emitter takes the same keyword fields, each template only uses some of them
+TEMPLATE_ARGS = "n=None, label=None, segment=None, index=None, fileName=None, funcName=None, nArgs=None, retAddrLabel=None"
+
+"""
+purpose: compile a template once so emitting it needs no copy or per element placeholder scan
+input: list of asm lines, possibly holding placeholders from TEMPLATE_FIELDS
+output: emitter function taking the template fields as keywords
+templates without placeholders return one shared tuple (never copied), the others are turned into
+a function that builds the list directly, eg. push -> lambda ...: [f'@{segment}', 'D=M', f'@{index}', ...]
+"""
+def compileTemplate(template):
+    if not any(line in TEMPLATE_FIELDS for line in template):
+        lines = tuple(template)
+        return lambda **fields: lines
+    items = ', '.join(TEMPLATE_FIELDS.get(line, repr(line)) for line in template)
+    return eval(f"lambda {TEMPLATE_ARGS}: [{items}]")
+
+
+# with D = y (top of stack) and M = x: the subtraction each comparison does and the jump taken when
+# it's true. eq: y - x == 0, gt: x - y > 0, lt: y - x > 0, the same as the inline templates
+COMPARISONS = {
+    'eq': ['D=D-M', 'D;JEQ'],
+    'gt': ['D=M-D', 'D;JGT'],
+    'lt': ['D=D-M', 'D;JGT'],
+}
+
+# fused compare and branch commands (optimizer.py), same subtractions as COMPARISONS
+# the negated forms jump on the opposite condition
+FUSED_BRANCHES = {
+    'if-eq-goto': ['D=D-M', 'D;JEQ'],
+    'if-ne-goto': ['D=D-M', 'D;JNE'],
+    'if-gt-goto': ['D=M-D', 'D;JGT'],
+    'if-le-goto': ['D=M-D', 'D;JLE'],
+    'if-lt-goto': ['D=D-M', 'D;JGT'],
+    'if-ge-goto': ['D=D-M', 'D;JLE'],
+}
+
+
 # object that holds looks up a vm vommand and returns the asm code
 class VmCmdLookup:
-    def __init__(self):
+    # compiled templates are shared by every lookup object, built the first time one is created
+    _compiled = None
+
+    # translation options live on the lookup object since it is handed to every translateVMtoASM call
+    # sharedCalls: call/return jump to one global routine each (see "shared routines") instead of
+    #              inlining the whole frame save/restore at every site
+    # sharedComparisons: eq/gt/lt jump to a shared subroutine per comparison instead of being inlined
+    # peephole: run peepholeOptimize (optimizer.py) over each file's commands before translating
+    # fuseBranches: comparisons followed by a branch on the result become one if-XX-goto
+    # cacheTop: translate with translateCachedVMtoASM, keeping the top of stack in D between commands
+    def __init__(self, sharedCalls=False, sharedComparisons=False, peephole=False, fuseBranches=False,
+                 cacheTop=False):
+        self.sharedCalls = sharedCalls
+        self.sharedComparisons = sharedComparisons
+        self.peephole = peephole
+        self.fuseBranches = fuseBranches
+        self.cacheTop = cacheTop
+        # translation state for cacheTop: True while the top of stack is only in D (not stored, SP not
+        # moved past it)
+        self.topInD = False
         self._ASM_translation = {
             "push": [
                 # sets A to the segment + seg_idx address
@@ -228,175 +351,288 @@ class VmCmdLookup:
                 # goto retAddr
                 '@R14', 'A=M', '0;JMP',
             ],
+            # templates for the segments that don't go through a base pointer
+            "push temp": [
+                # sets addr to segment base addr + segment_idx value
+                '@5', 'D=A', '@seg_idx', 'D=D+A', 'A=D',
+                # grabs value at that segment index's address, stores in D, then puts on top of stack
+                'D=M', '@SP', 'A=M', 'M=D',
+                # SP++
+                '@SP', 'M=M+1',
+            ],
+            "pop temp": [
+                # sets addr to segment base addr + segment_idx value
+                '@5', 'D=A', '@seg_idx', 'D=D+A', '@R15', 'M=D',
+                # SP--
+                '@SP', 'M=M-1',
+                # *addr = *SP
+                'A=M', 'D=M', '@R15', 'A=M', 'M=D'
+            ],
+            "push constant": [
+                # sets D to const value
+                '@seg_idx', 'D=A',
+                # pushes D value to stack
+                '@SP', 'A=M', 'M=D',
+                # SP++
+                '@SP', 'M=M+1'
+            ],
+            "push static": [
+                '@fileName.seg_idx', 'D=M',
+                '@SP', 'A=M', 'M=D',
+                '@SP', 'M=M+1'
+            ],
+            "pop static": [
+                '@SP', 'M=M-1', 'A=M', 'D=M',
+                '@fileName.seg_idx', 'M=D'
+            ],
+            # pointer 0 is THIS, pointer 1 is THAT
+            "push pointer": [
+                # grab value in THIS/THAT
+                '@segment', 'D=M',
+                # push to top of stack
+                '@SP', 'A=M', 'M=D',
+                # SP++
+                '@SP', 'M=M+1'
+            ],
+            "pop pointer": [
+                # select value at top of stack, SP--
+                '@SP', 'M=M-1', 'A=M', 'D=M',
+                # go to THIS/THAT, and store D there
+                '@segment', 'M=D'
+            ],
+            "function": [
+                # inject entry point label, locals are added per call to emit
+                '(funcName)'
+            ],
+            # one local initialized to 0
+            "function local": [
+                '@0', 'D=A',
+                # go to top of stack and push D
+                '@SP', 'A=M', 'M=D',
+                # SP++
+                '@SP', 'M=M+1'
+            ],
+            "call": [
+                # 1. push retAddrLabel
+                '@retAddrLabel',
+                'D=A', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+                # 2. push LCL, ARG, THIS, THAT -> save stack Frame
+                '@LCL', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+                '@ARG', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+                '@THIS', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+                '@THAT', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+                # 3. reposition ARG & LCL
+                # ARG = SP - 5 - nArgs
+                '@nArgs', 'D=A', '@5', 'D=D+A',
+                '@SP', 'D=M-D', '@ARG', 'M=D',
+                # LCL = SP
+                '@SP', 'D=M', '@LCL', 'M=D',
+                # 4. transfer control to callee
+                '@funcName', '0;JMP',
+                # 5. injects retAddrLabel
+                '(retAddrLabel)'
+            ],
+            # call site when calls are shared, the routine gets:
+            # R13 = callee address, R14 = return address, D = nArgs
+            "call shared": [
+                '@funcName', 'D=A', '@R13', 'M=D',
+                '@retAddrLabel', 'D=A', '@R14', 'M=D',
+                '@nArgs', 'D=A',
+                '@__CALL', '0;JMP',
+                '(retAddrLabel)'
+            ],
+            "return shared": [
+                '@__RETURN', '0;JMP'
+            ],
+            # commands only produced by the optimizer, see optimizer.py
+            "push-true": [
+                # true is -1, no need to go through D
+                '@SP', 'A=M', 'M=-1',
+                # SP++
+                '@SP', 'M=M+1'
+            ],
+            "if-not-goto": [
+                # Pop value from stack into D
+                '@SP', 'M=M-1', 'A=M', 'D=M',
+                # if D == 0, jump
+                '@_LABEL', 'D;JEQ'
+            ],
+            "store-that": [
+                # temp 0 = value
+                '@SP', 'AM=M-1', 'D=M', '@R5', 'M=D',
+                # THAT = address
+                '@SP', 'AM=M-1', 'D=M', '@THAT', 'M=D',
+                # *THAT = value
+                '@R5', 'D=M', '@THAT', 'A=M', 'M=D'
+            ],
         }
-    
+        # comparisons when they are shared, the site passes its return address in R13
+        # and the subroutine leaves true (-1) or false (0) on the stack like the inline version
+        self._ASM_translation["comparison routines"] = []
+        for op, (compute, jump) in COMPARISONS.items():
+            routine = f'__{op.upper()}'
+            self._ASM_translation[f'{op} shared'] = [
+                '@RET_N', 'D=A', '@R13', 'M=D',
+                f'@{routine}', '0;JMP',
+                '(RET_N)'
+            ]
+            self._ASM_translation["comparison routines"].extend([
+                f'({routine})',
+                # D = y, SP--, select x
+                '@SP', 'M=M-1', 'A=M', 'D=M', 'A=A-1',
+                compute,
+                # assume true, keep it if the jump is taken
+                'M=-1', f'@{routine}_END', jump,
+                # false, x is right below SP
+                '@SP', 'A=M-1', 'M=0',
+                f'({routine}_END)',
+                # back to the caller
+                '@R13', 'A=M', '0;JMP',
+            ])
+        # fused compare and branch, jump on the result instead of pushing it
+        for command, (compute, jump) in FUSED_BRANCHES.items():
+            self._ASM_translation[command] = [
+                # D = y, select x
+                '@SP', 'AM=M-1', 'D=M', 'A=A-1',
+                compute,
+                # both values are popped
+                '@SP', 'M=M-1',
+                '@_LABEL', jump
+            ]
+        # written once per program (after the bootstrap) when calls are shared
+        # __CALL is the call template driven by registers, __RETURN is the return template as is
+        self._ASM_translation["shared routines"] = [
+            '(__CALL)',
+            # R15 = nArgs + 5, how far ARG sits below the new SP
+            '@5', 'D=D+A', '@R15', 'M=D',
+            # push return address
+            '@R14', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            # push LCL, ARG, THIS, THAT -> save stack Frame
+            '@LCL', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            '@ARG', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            '@THIS', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            '@THAT', 'D=M', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
+            # ARG = SP - 5 - nArgs
+            '@R15', 'D=M', '@SP', 'D=M-D', '@ARG', 'M=D',
+            # LCL = SP
+            '@SP', 'D=M', '@LCL', 'M=D',
+            # transfer control to callee
+            '@R13', 'A=M', '0;JMP',
+            '(__RETURN)',
+        ] + self._ASM_translation["return"]
+        if VmCmdLookup._compiled is None:
+            VmCmdLookup._compiled = {
+                command: compileTemplate(template) for command, template in self._ASM_translation.items()
+            }
+        self._compiled = VmCmdLookup._compiled
+
     def lookup_vm_cmd(self, command):
         return self._ASM_translation[command]
-    
+
+    # returns the compiled emitter for a command, call it with the template fields to get the asm lines
+    # templates without fields come back as a shared tuple, so callers must not modify them
+    def emitter(self, command):
+        return self._compiled[command]
+
+    # number of instructions a template assembles to (labels take no ROM)
+    def instructionCount(self, command):
+        return sum(1 for line in self._ASM_translation[command] if not line.startswith('('))
+
+    # [fewest, most] instructions run going through a template (or a routine inside one, from its label)
+    # jumps to labels outside the template end the path
+    def cycleRange(self, command, start=None):
+        lines = self._ASM_translation[command]
+        labels = {line[1:-1]: i for i, line in enumerate(lines) if line.startswith('(')}
+        lengths = []
+        # the templates have no loops, so every path is walked: [position, instructions so far]
+        paths = [[labels[start] if start else 0, 0]]
+        while paths:
+            i, count = paths.pop()
+            while i < len(lines):
+                line = lines[i]
+                if line.startswith('('):
+                    i += 1
+                    continue
+                count += 1
+                if ';J' in line:
+                    target = lines[i - 1][1:]
+                    if line != '0;JMP':
+                        # conditional, also follow the fall through
+                        paths.append([i + 1, count])
+                    if target not in labels:
+                        break
+                    i = labels[target]
+                    continue
+                i += 1
+            lengths.append(count)
+        return [min(lengths), max(lengths)]
+
+
+# base pointer symbol of the segments that are accessed through one
+segment_name_keyword = {
+    'local': 'LCL',
+    'argument': 'ARG',
+    'this': 'THIS',
+    'that': 'THAT',
+}
+
+# pointer index -> symbol it stands for
+pointer_keyword = {
+    0: 'THIS',
+    1: 'THAT',
+}
+
+
+# labels are local to their function (functionName$label) so functions can reuse names
+def scopedLabel(label, currentFunction):
+    return f'{currentFunction}${label}' if currentFunction else label
+
 
 """
 purpose: translare vm input (line by line) to hack asm output
-input: input array
-output
+input: parsed vm command (VmCommand), lookup object, unique number for comparison labels, name of the
+       function the command is in (labels are scoped to it), call counter (for return address labels)
+       and file name (for statics and comparison labels)
+output: sequence of asm lines (may be a shared tuple, don't modify it)
 """
-def translateVMtoASM(input, Vmlookup, label_cnt, lastFuncLabel, callCounter, fileName):
+def translateVMtoASM(command, Vmlookup, label_cnt, currentFunction, callCounter, fileName):
     ret = ["// something went wrong - default"]
-    if len(input) == 1:
-        # arithmetic/boolean stack operation & return
-        ret = Vmlookup.lookup_vm_cmd(input[0]).copy()
-        for i in range(len(ret)):
-            if ret[i] == '@T_N':
-                ret[i] = str(f'@T_{label_cnt}')
-            if ret[i] == '@END_N':
-                ret[i] = str(f'@END_{label_cnt}')
-            if ret[i] == '(T_N)':
-                ret[i] = str(f'(T_{label_cnt})')
-            if ret[i] == '(END_N)':
-                ret[i] = str(f'(END_{label_cnt})')
-            # if ret[i] == '@returnAddr':
-            #     ret[i] = str(f'@returnAddr_{lastFuncLabel}')
-            # if ret[i] == '@endFrame':
-            #     ret[i] = str(f'@endFrame_{lastFuncLabel}')
-    elif len(input) == 2:
-        ret = Vmlookup.lookup_vm_cmd(input[0]).copy()
-        for i in range(len(ret)):
-            if ret[i] == '(LABEL)':
-                ret[i] = f'({input[1]})'
-            elif ret[i] == '@_LABEL':
-                ret[i] = f'@{input[1]}'
-            elif ret[i] == '@_NAME':
-                ret[i] = f'@{input[1]}'
-
-        pass
-    elif len(input) == 3:
-        # push segment i, pop segment i, function funcName nVars, call funcName nArgs
+    op = command.op
+    if op in MEMORY_OPS:
+        # push segment i, pop segment i
         # special cases are constant, static, and pointer
-        if input[0] == 'pop' or input[0] == 'push':
-            segment_name_keyword = {
-                'local': 'LCL',
-                # 'temp': '5',
-                'argument': 'ARG',
-                'this': 'THIS',
-                'that': 'THAT',
-            }
-
-            if input[1] in segment_name_keyword:
-                tmp = Vmlookup.lookup_vm_cmd(input[0]).copy()
-
-                # loop through returned arr, if any arr[i] in kwd_lookup, replace: arr[i] = kwd_l[arr[i]]
-                for i in range(len(tmp)):
-                    if tmp[i] == '@segment':
-                        tmp[i] = '@' + segment_name_keyword[input[1]]
-                    if tmp[i] == '@seg_idx':
-                        tmp[i] = '@' + input[2]
-            elif input[1] == 'temp':
-                if input[0] == 'pop':
-                    tmp = [
-                        # sets addr to segment base addr + segment_idx value
-                        '@5', 'D=A', f'@{input[2]}', 'D=D+A', '@R15', 'M=D',
-                        # SP--
-                        '@SP', 'M=M-1',
-                        # *addr = *SP
-                        'A=M', 'D=M', '@R15', 'A=M', 'M=D'
-                    ]
-                if input[0] == 'push':
-                    tmp = [
-                        # sets addr to segment base addr + segment_idx value
-                        '@5', 'D=A', f'@{input[2]}', 'D=D+A', 'A=D',
-                        # grabs value at that segment index's address, stores in D, then puts on top of stack
-                        'D=M', '@SP', 'A=M', 'M=D',
-                        # SP++
-                        '@SP', 'M=M+1',
-                    ]
-            elif input[1] == 'constant':
-                # is special push
-                tmp = [
-                    # sets D to const value
-                    f'@{input[2]}', 'D=A',
-                    # pushes D value to stack
-                    '@SP', 'A=M', 'M=D',
-                    # SP++
-                    '@SP', 'M=M+1'
-                ]     
-            elif input[1] == 'static':
-                if input[0] == 'pop':
-                    tmp = [
-                        '@SP', 'M=M-1', 'A=M', 'D=M',
-                        f'@{fileName}.{input[2]}', 'M=D'
-                    ]
-                if input[0] == 'push':
-                    tmp = [
-                        f'@{fileName}.{input[2]}', 'D=M',
-                        '@SP', 'A=M', 'M=D',
-                        '@SP', 'M=M+1'
-                    ]
-            elif input[1] == 'pointer':
-                tmp = ['// error ' ]
-                if input[2] == '0':
-                    # THIS
-                    if input[0] == 'pop':
-                        tmp = [
-                            # select value at top of stack, SP--
-                            '@SP', 'M=M-1', 'A=M', 'D=M',
-                            # go to THAT, and store D there
-                            '@THIS', 'M=D'
-
-                        ]
-                    if input[0] == 'push':
-                        tmp = [
-                            # grab value in THAT
-                            '@THIS', 'D=M',
-                            # push to top of stack
-                            '@SP', 'A=M', 'M=D',
-                            # SP++
-                            '@SP', 'M=M+1'
-                        ]
-                elif input[2] == '1':
-                    # THAT
-                    if input[0] == 'pop':
-                        tmp = [
-                            # select value at top of stack, SP--
-                            '@SP', 'M=M-1', 'A=M', 'D=M',
-                            # go to THAT, and store D there
-                            '@THAT', 'M=D'
-
-                        ]
-                    if input[0] == 'push':
-                        tmp = [
-                            # grab value in THAT
-                            '@THAT', 'D=M',
-                            # push to top of stack
-                            '@SP', 'A=M', 'M=D',
-                            # SP++
-                            '@SP', 'M=M+1'
-                        ]
-        elif input[0] == 'function':
+        name, segment, index = OP_TEXT[op], command.segment, command.arg
+        if segment in segment_name_keyword:
+            ret = Vmlookup.emitter(name)(segment=segment_name_keyword[segment], index=index)
+        elif segment == 'stack':
+            # slots counted from SP, from inlined functions
+            if op == Op.PUSH:
+                ret = loadToD(segment, index, fileName) + ['@SP', 'AM=M+1', 'A=A-1', 'M=D']
+            else:
+                ret = POP_TO_D + storeFromD(segment, index, fileName)
+        elif segment == 'pointer':
+            if index in pointer_keyword:
+                ret = Vmlookup.emitter(f'{name} pointer')(segment=pointer_keyword[index])
+            else:
+                ret = ['// error ']
+        elif f'{name} {segment}' in Vmlookup._compiled:
+            # temp, constant, static (name is the file of a static from an inlined function)
+            ret = Vmlookup.emitter(f'{name} {segment}')(index=index, fileName=command.name or fileName)
+        else:
+            ret = ['// error ']
+    elif op in BRANCH_OPS:
+        # label, goto, if-goto
+        ret = Vmlookup.emitter(OP_TEXT[op])(label=scopedLabel(command.name, currentFunction))
+    elif op in NAMED_OPS:
+        if op == Op.FUNCTION:
             """
                 function funcName, nVars
                 1. injectt entry point label
-                2. initialize local segment of the callee
+                2. initialize local segment of the callee (push 0 nVars number of times)
             """
-
-            tmp = ['// error: function asm']
-            funcName, nVars = input[1:3]
-
-            # 1. inject entry point label
-            tmp = [
-                f'({funcName})'
-            ]
-
-            # 2. intialize local segment of callee (push 0 nVars number of times)
-            for _ in range(int(nVars)):
-                tmp.extend([
-                        '@0', 'D=A',
-                        # go to top of stack and push D
-                        '@SP', 'A=M', 'M=D',
-                        # SP++
-                        '@SP', 'M=M+1'
-                    ])
-            
-
-        elif input[0] == 'call':
+            ret = Vmlookup.emitter('function')(funcName=command.name)
+            ret.extend(Vmlookup.emitter('function local')() * command.arg)
+        else:
             """
                 call funcName nArgs
                 function call template:
@@ -406,56 +642,159 @@ def translateVMtoASM(input, Vmlookup, label_cnt, lastFuncLabel, callCounter, fil
                 4. transfer control to callee
                 5. injects retAddrLabel
             """
-            tmp = ['// error: call asm']
-            funcName, nArgs = input[1:3]
-
-            # 1. push retAddrLabel
-            tmp = [
-                f'@retAddr_{fileName}_{callCounter}',
-                'D=A', '@SP', 'A=M', 'M=D', '@SP', 'M=M+1',
-            ]
-            
-            # 2. push LCL, ARG, THIS, THAT -> save stack Frame
-            stackFrameElements = ['LCL', 'ARG', 'THIS', 'THAT']
-            for segName in stackFrameElements:
-                asm_code = [
-                        # get caller address for stack frame element (memory segment base addr)
-                        f'@{segName}', 'D=M',
-                        # go to top of stack and push D
-                        '@SP', 'A=M', 'M=D',
-                        # SP++
-                        '@SP', 'M=M+1'
-                    ]
-                tmp.extend(asm_code.copy())
-            
-            # 3. reposition ARG & LCL
-            tmp.extend([
-                    # ARG = SP - 5 - nArgs
-                    f'@{nArgs}', 'D=A', '@5', 'D=D+A', 
-                    '@SP', 'D=M-D', '@ARG', 'M=D',
-                    # LCL = SP
-                    '@SP', 'D=M', '@LCL', 'M=D',
-                ])
-
-            # 4. transfer control to callee
-            tmp.extend([
-                        f'@{funcName}', '0;JMP'
-                    ])
-            
-            # 5. injects retAddrLabel
-            tmp.extend([
-                f'(retAddr_{fileName}_{callCounter})'
-            ])
-
-            # print(tmp)
+            callTemplate = 'call shared' if Vmlookup.sharedCalls else 'call'
+            ret = Vmlookup.emitter(callTemplate)(funcName=command.name, nArgs=command.arg,
+                                                 retAddrLabel=f'retAddr_{fileName}_{callCounter}')
+    elif op in SPECIAL_OPS:
+        if op == Op.DROP:
+            # SP -= n, from inlined returns
+            count = command.arg
+            ret = ['@SP', 'M=M-1'] * count if count <= 2 else [f'@{count}', 'D=A', '@SP', 'M=M-D']
         else:
-            tmp = ['// error ']     
-
-        ret = tmp
+            ret = ["// command too long"] if command.name.count(' ') > 2 else ['// error ']
+    elif Vmlookup.sharedCalls and op == Op.RETURN:
+        ret = Vmlookup.emitter('return shared')()
+    elif Vmlookup.sharedComparisons and op in COMPARISON_OPS:
+        ret = Vmlookup.emitter(f'{OP_TEXT[op]} shared')(n=label_cnt, fileName=fileName)
     else:
-        ret = ["// command too long"]
+        # arithmetic/boolean stack operation & return
+        # eq/gt/lt need unique labels
+        ret = Vmlookup.emitter(OP_TEXT[op])(n=label_cnt, fileName=fileName)
     return ret
 
+# pushes D, makes the cached top of stack a normal stack entry
+FLUSH_TOP = ['@SP', 'AM=M+1', 'A=A-1', 'M=D']
+# pops the top of stack into D
+POP_TO_D = ['@SP', 'AM=M-1', 'D=M']
+# with y in D, pops x and combines: D = x op y
+BINARY_IN_D = {
+    Op.ADD: 'D=D+M',
+    Op.SUB: 'D=M-D',
+    Op.AND: 'D=D&M',
+    Op.OR: 'D=D|M',
+}
+UNARY_IN_D = {
+    Op.NEG: 'D=-D',
+    Op.NOT: 'D=!D',
+}
+
+
+# asm that loads the value "push segment index" would push into D, None for unknown segments
+# fileName is the file statics belong to
+def loadToD(segment, index, fileName):
+    if segment == 'constant':
+        return [f'@{index}', 'D=A']
+    if segment in segment_name_keyword:
+        if index == 0:
+            return [f'@{segment_name_keyword[segment]}', 'A=M', 'D=M']
+        return [f'@{segment_name_keyword[segment]}', 'D=M', f'@{index}', 'A=D+A', 'D=M']
+    if segment == 'temp':
+        return [f'@{5 + index}', 'D=M']
+    if segment == 'static':
+        return [f'@{fileName}.{index}', 'D=M']
+    if segment == 'pointer' and index in pointer_keyword:
+        return [f'@{pointer_keyword[index]}', 'D=M']
+    if segment == 'stack':
+        return ['@SP', 'D=M', f'@{index}', 'A=D-A', 'D=M']
+    return None
+
+
+# asm that stores D where "pop segment index" would, None for unknown segments. SP has to be past
+# the popped value already. small offsets are walked to with A=A+1 (A=A-1 for stack slots), larger
+# ones go through R13/R14 since D is taken
+def storeFromD(segment, index, fileName):
+    if segment == 'stack':
+        # the slot is index entries below SP before the pop, one less now
+        offset = index - 1
+        if offset <= 8:
+            return ['@SP', 'A=M'] + ['A=A-1'] * offset + ['M=D']
+        return ['@R13', 'M=D', '@SP', 'D=M', f'@{offset}', 'D=D-A', '@R14', 'M=D',
+                '@R13', 'D=M', '@R14', 'A=M', 'M=D']
+    if segment in segment_name_keyword:
+        base = segment_name_keyword[segment]
+        if index <= 8:
+            return [f'@{base}', 'A=M'] + ['A=A+1'] * index + ['M=D']
+        return ['@R13', 'M=D', f'@{base}', 'D=M', f'@{index}', 'D=D+A', '@R14', 'M=D',
+                '@R13', 'D=M', '@R14', 'A=M', 'M=D']
+    if segment == 'temp':
+        return [f'@{5 + index}', 'M=D']
+    if segment == 'static':
+        return [f'@{fileName}.{index}', 'M=D']
+    if segment == 'pointer' and index in pointer_keyword:
+        return [f'@{pointer_keyword[index]}', 'M=D']
+    return None
+
+
+"""
+purpose: translate a vm command keeping the top of stack in D where it can (cacheTop mode)
+input: same as translateVMtoASM, the caching state is Vmlookup.topInD
+output: list of asm lines
+pushes leave their value in D instead of storing it, and commands that pop it take it from D, so
+a push followed by eg. add or pop skips the store and reload. anything else (labels, goto, calls,
+return, function) first flushes D onto the stack and is translated by translateVMtoASM. the caller
+has to emit flushTop at the end of the code
+"""
+def translateCachedVMtoASM(command, Vmlookup, label_cnt, currentFunction, callCounter, fileName):
+    op = command.op
+    cached = Vmlookup.topInD
+    # lines that get the top of stack into D, for commands that pop it
+    topToD = [] if cached else POP_TO_D
+
+    if op == Op.PUSH:
+        load = loadToD(command.segment, command.arg, command.name or fileName)
+        if load is not None:
+            Vmlookup.topInD = True
+            return (FLUSH_TOP if cached else []) + load
+    elif op == Op.PUSH_TRUE:
+        Vmlookup.topInD = True
+        return (FLUSH_TOP if cached else []) + ['D=-1']
+    elif op == Op.POP:
+        store = storeFromD(command.segment, command.arg, command.name or fileName)
+        if store is not None:
+            Vmlookup.topInD = False
+            return topToD + store
+    elif op in BINARY_IN_D:
+        Vmlookup.topInD = True
+        return topToD + ['@SP', 'AM=M-1', BINARY_IN_D[op]]
+    elif op in UNARY_IN_D and cached:
+        return [UNARY_IN_D[op]]
+    elif op in COMPARISON_OPS and not Vmlookup.sharedComparisons:
+        compute, jump = COMPARISONS[OP_TEXT[op]]
+        Vmlookup.topInD = True
+        return topToD + [
+            '@SP', 'AM=M-1', compute,
+            f'@T_{fileName}_{label_cnt}', jump,
+            # false
+            'D=0', f'@END_{fileName}_{label_cnt}', '0;JMP',
+            f'(T_{fileName}_{label_cnt})', 'D=-1',
+            f'(END_{fileName}_{label_cnt})'
+        ]
+    elif (op == Op.IF_GOTO or op == Op.IF_NOT_GOTO) and cached:
+        Vmlookup.topInD = False
+        return [f'@{scopedLabel(command.name, currentFunction)}', 'D;JNE' if op == Op.IF_GOTO else 'D;JEQ']
+    elif OP_TEXT.get(op) in FUSED_BRANCHES and cached:
+        compute, jump = FUSED_BRANCHES[OP_TEXT[op]]
+        Vmlookup.topInD = False
+        return ['@SP', 'AM=M-1', compute, f'@{scopedLabel(command.name, currentFunction)}', jump]
+    elif op == Op.STORE_THAT and cached:
+        Vmlookup.topInD = False
+        return ['@R5', 'M=D', '@SP', 'AM=M-1', 'D=M', '@THAT', 'M=D',
+                '@R5', 'D=M', '@THAT', 'A=M', 'M=D']
+
+    # everything else works on the stack in memory
+    Vmlookup.topInD = False
+    ret = translateVMtoASM(command, Vmlookup, label_cnt, currentFunction, callCounter, fileName)
+    return (FLUSH_TOP + list(ret)) if cached else ret
+
+
+# lines that store a cached top of stack, for the end of the translated code
+def flushTop(Vmlookup):
+    if not Vmlookup.topInD:
+        return []
+    Vmlookup.topInD = False
+    return FLUSH_TOP
+
+
 # flattens list (depth 1level), ex: 
 # input = [1,[2,4],[123,12,2,]]
 # output = [1, 2, 4, 123, 12, 2]
@@ -479,7 +818,58 @@ def writeListToFile(data, fileName, inputNumber):
             else:
                 f.write(data[i])
 
-def writeBoostrapASM():
+"""
+purpose: single writer for a whole .asm output
+opened once (truncating any stale output), lines are collected into blocks that are joined and
+written through one buffered stream. lines are separated by '\n' with no trailing newline,
+the same layout writeListToFile produced
+"""
+class AsmWriter:
+    def __init__(self, fileName, blockSize=8192):
+        self.f = open(fileName, 'w', buffering=1 << 16)
+        self.blockSize = blockSize
+        self.block = []
+        self.linesWritten = 0
+
+    # takes any iterable of lines, including a generator straight from the translator
+    def writeLines(self, lines):
+        for line in lines:
+            self.block.append(line)
+            if len(self.block) >= self.blockSize:
+                self.flush()
+
+    # takes lines that were already joined with '\n' (eg. a whole translated file)
+    def writeText(self, text):
+        if not text:
+            return
+        self.flush()
+        if self.linesWritten > 0:
+            self.f.write('\n')
+        self.f.write(text)
+        self.linesWritten += text.count('\n') + 1
+
+    def flush(self):
+        if not self.block:
+            return
+        if self.linesWritten > 0:
+            self.f.write('\n')
+        self.f.write('\n'.join(self.block))
+        self.linesWritten += len(self.block)
+        self.block = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# bootstrap code, followed by the shared call/return and comparison routines when the lookup object
+# asks for them. Sys.init never returns, so nothing falls through into the routines
+def writeBoostrapASM(Vmlookup=None):
     tmp = [
         # SP = 256; setting stack pointer
         '// Boostrap: set SP to 256', '@256', 'D=A', '@SP', 'M=D',
@@ -523,6 +913,66 @@ def writeBoostrapASM():
     tmp.extend([
         f'(retAddr_bootstrap_sys_init)'
     ])
+
+    if Vmlookup is not None and Vmlookup.sharedCalls:
+        tmp.append('// shared call/return routines')
+        tmp.extend(Vmlookup.lookup_vm_cmd('shared routines'))
+    if Vmlookup is not None and Vmlookup.sharedComparisons:
+        tmp.append('// shared comparison routines')
+        tmp.extend(Vmlookup.lookup_vm_cmd('comparison routines'))
     
     return tmp
 
+
+"""
+purpose: show what sharing the call/return routines saved
+input: counts of each vm command translated, lookup object
+output: list of report lines: call/return sites, ROM instructions saved and the extra cycles per call/return
+every template is straight line code, so the instruction counts are also the cycles spent running them
+"""
+def sharedCallReport(commandCounts, Vmlookup):
+    calls = commandCounts.get('call', 0)
+    returns = commandCounts.get('return', 0)
+    inlineCall = Vmlookup.instructionCount('call')
+    inlineReturn = Vmlookup.instructionCount('return')
+    callSite = Vmlookup.instructionCount('call shared')
+    returnSite = Vmlookup.instructionCount('return shared')
+    routines = Vmlookup.instructionCount('shared routines')
+    # the __CALL part of the routines, everything before the __RETURN label
+    sharedLines = Vmlookup.lookup_vm_cmd('shared routines')
+    callRoutine = sum(1 for line in sharedLines[:sharedLines.index('(__RETURN)')] if not line.startswith('('))
+
+    inlineSize = calls * inlineCall + returns * inlineReturn
+    sharedSize = calls * callSite + returns * returnSite + routines
+    return [
+        f'shared calls: {calls} call sites, {returns} returns',
+        f'call/return code: {inlineSize} instructions inline, {sharedSize} shared '
+        f'({inlineSize - sharedSize} saved)',
+        f'cycles per call: {inlineCall} inline, {callSite + callRoutine} shared; '
+        f'per return: {inlineReturn} inline, {returnSite + inlineReturn} shared',
+    ]
+
+
+"""
+purpose: compare code size and cycles of inline and shared eq/gt/lt
+input: counts of each vm command translated, lookup object
+output: list of report lines: comparison count, ROM instructions for both settings, cycles per
+comparison for both settings (fewest-most, depending on the result)
+"""
+def comparisonReport(commandCounts, Vmlookup):
+    ops = ['eq', 'gt', 'lt']
+    comparisons = sum(commandCounts.get(op, 0) for op in ops)
+    inlineSize = sum(commandCounts.get(op, 0) * Vmlookup.instructionCount(op) for op in ops)
+    sharedSize = (sum(commandCounts.get(op, 0) * Vmlookup.instructionCount(f'{op} shared') for op in ops)
+                  + Vmlookup.instructionCount('comparison routines'))
+    report = [
+        f'comparisons: {comparisons} ({", ".join(f"{op} {commandCounts.get(op, 0)}" for op in ops)})',
+        f'comparison code: {inlineSize} instructions inline, {sharedSize} shared ({inlineSize - sharedSize} saved)',
+    ]
+    for op in ops:
+        inline = Vmlookup.cycleRange(op)
+        site = Vmlookup.instructionCount(f'{op} shared')
+        routine = Vmlookup.cycleRange('comparison routines', f'__{op.upper()}')
+        report.append(f'cycles per {op}: {inline[0]}-{inline[1]} inline, '
+                      f'{site + routine[0]}-{site + routine[1]} shared')
+    return report
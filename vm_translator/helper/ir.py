@@ -0,0 +1,184 @@
+"""
+
+Parsed form of vm commands
+Each cleaned line is parsed once into a VmCommand (opcode, segment, integer argument, name), the
+optimization passes and the translator work on those and never split strings again
+
+"""
+
+from functools import lru_cache
+
+
+# opcodes, plain int constants rather than an IntEnum: the passes compare against them for every
+# command and Enum attribute lookups cost several times a normal class attribute
+class Op:
+    PUSH = 0
+    POP = 1
+    ADD = 2
+    SUB = 3
+    NEG = 4
+    EQ = 5
+    GT = 6
+    LT = 7
+    AND = 8
+    OR = 9
+    NOT = 10
+    LABEL = 11
+    GOTO = 12
+    IF_GOTO = 13
+    FUNCTION = 14
+    CALL = 15
+    RETURN = 16
+    # only produced by the optimizer, see optimizer.py
+    PUSH_TRUE = 17
+    IF_NOT_GOTO = 18
+    STORE_THAT = 19
+    DROP = 20
+    IF_EQ_GOTO = 21
+    IF_NE_GOTO = 22
+    IF_GT_GOTO = 23
+    IF_LE_GOTO = 24
+    IF_LT_GOTO = 25
+    IF_GE_GOTO = 26
+    # a line that isn't a vm command, kept as the name
+    UNKNOWN = 27
+
+
+# vm keyword -> opcode, the commands of the vm language (all parseCommand accepts)
+OP_NAMES = {
+    'push': Op.PUSH,
+    'pop': Op.POP,
+    'add': Op.ADD,
+    'sub': Op.SUB,
+    'neg': Op.NEG,
+    'eq': Op.EQ,
+    'gt': Op.GT,
+    'lt': Op.LT,
+    'and': Op.AND,
+    'or': Op.OR,
+    'not': Op.NOT,
+    'label': Op.LABEL,
+    'goto': Op.GOTO,
+    'if-goto': Op.IF_GOTO,
+    'function': Op.FUNCTION,
+    'call': Op.CALL,
+    'return': Op.RETURN,
+}
+# keywords of the commands only the optimizer makes, for printing them (never parsed from input)
+INTERNAL_OP_NAMES = {
+    'push-true': Op.PUSH_TRUE,
+    'if-not-goto': Op.IF_NOT_GOTO,
+    'store-that': Op.STORE_THAT,
+    'drop': Op.DROP,
+    'if-eq-goto': Op.IF_EQ_GOTO,
+    'if-ne-goto': Op.IF_NE_GOTO,
+    'if-gt-goto': Op.IF_GT_GOTO,
+    'if-le-goto': Op.IF_LE_GOTO,
+    'if-lt-goto': Op.IF_LT_GOTO,
+    'if-ge-goto': Op.IF_GE_GOTO,
+}
+# opcode -> vm keyword, also the name of its template in VmCmdLookup
+OP_TEXT = {op: text for names in (OP_NAMES, INTERNAL_OP_NAMES) for text, op in names.items()}
+
+# push/pop segment index
+MEMORY_OPS = frozenset([Op.PUSH, Op.POP])
+# commands taking a label
+BRANCH_OPS = frozenset([Op.LABEL, Op.GOTO, Op.IF_GOTO, Op.IF_NOT_GOTO, Op.IF_EQ_GOTO, Op.IF_NE_GOTO,
+                        Op.IF_GT_GOTO, Op.IF_LE_GOTO, Op.IF_LT_GOTO, Op.IF_GE_GOTO])
+# function name nVars, call name nArgs
+NAMED_OPS = frozenset([Op.FUNCTION, Op.CALL])
+# commands translated by hand rather than from a template
+SPECIAL_OPS = frozenset([Op.DROP, Op.UNKNOWN])
+COMPARISON_OPS = frozenset([Op.EQ, Op.GT, Op.LT])
+
+
+"""
+one vm command
+op: Op, segment: segment name for push/pop, arg: index/count as an int,
+name: label or function name (the File of "static File.i", the line itself for UNKNOWN),
+text: the vm line, kept from parsing or built for commands the optimizer makes
+"""
+class VmCommand:
+    __slots__ = ('op', 'segment', 'arg', 'name', 'text')
+
+    def __init__(self, op, segment=None, arg=None, name=None, text=None):
+        self.op = op
+        self.segment = segment
+        self.arg = arg
+        self.name = name
+        self.text = text if text is not None else self.format()
+
+    def __str__(self):
+        return self.text
+
+    # back to vm text, the same as the line it was parsed from
+    def format(self):
+        op = self.op
+        if op in MEMORY_OPS:
+            index = f'{self.name}.{self.arg}' if self.name else self.arg
+            return f'{OP_TEXT[op]} {self.segment} {index}'
+        if op in BRANCH_OPS:
+            return f'{OP_TEXT[op]} {self.name}'
+        if op in NAMED_OPS:
+            return f'{OP_TEXT[op]} {self.name} {self.arg}'
+        if op == Op.DROP:
+            return f'drop {self.arg}'
+        if op == Op.UNKNOWN:
+            return self.name
+        return OP_TEXT[op]
+
+    def __repr__(self):
+        return f'VmCommand({self})'
+
+    def __eq__(self, other):
+        return (isinstance(other, VmCommand) and self.op == other.op and self.segment == other.segment
+                and self.arg == other.arg and self.name == other.name)
+
+    def __hash__(self):
+        return hash((self.op, self.segment, self.arg, self.name))
+
+
+# operands that aren't a plain number make the command UNKNOWN
+# (isdigit alone also takes digits like '²' that int() rejects)
+def isNumber(text):
+    return text.isascii() and text.isdigit()
+
+
+"""
+purpose: parse one cleaned vm line
+input: line from cleanLines/cleanRawInput
+output: VmCommand, UNKNOWN if the line isn't a valid command
+raises ValueError for an unknown keyword in a line of one or two words, like the original translator
+did. longer lines stay UNKNOWN, they are translated into an error comment
+most lines repeat (add, push constant 0, return...), so recent ones are cached and the same command
+object is handed out again: commands are never modified after parsing
+"""
+@lru_cache(maxsize=4096)
+def parseCommand(line):
+    parts = line.split(' ')
+    op = OP_NAMES.get(parts[0])
+    if op is not None:
+        if op in MEMORY_OPS:
+            if len(parts) == 3:
+                name, index = None, parts[2]
+                if parts[1] == 'static' and '.' in index:
+                    # File.i, a static of a function inlined from another file
+                    name, index = index.rsplit('.', 1)
+                if isNumber(index):
+                    return VmCommand(op, parts[1], int(index), name, line)
+        elif op in BRANCH_OPS:
+            if len(parts) == 2:
+                return VmCommand(op, name=parts[1], text=line)
+        elif op in NAMED_OPS:
+            if len(parts) == 3 and isNumber(parts[2]):
+                return VmCommand(op, arg=int(parts[2]), name=parts[1], text=line)
+        elif len(parts) == 1:
+            return VmCommand(op, text=line)
+    elif len(parts) < 3:
+        raise ValueError(f'unknown vm command: {line}')
+    return VmCommand(Op.UNKNOWN, name=line, text=line)
+
+
+# parses cleaned lines one at a time
+def parseCommands(lines):
+    return map(parseCommand, lines)
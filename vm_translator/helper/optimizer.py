@@ -0,0 +1,358 @@
+"""
+
+VM level optimizations, run on the parsed commands (VmCommand, see ir.py) before translateVMtoASM
+sees them. the per file passes are generators, they take and give a stream of commands
+
+Besides standard vm commands the rewrites can produce a few commands that only the translator
+understands:
+    push-true         push -1 (true is written as push constant 0 / not, or push constant 1 / neg
+                      by compiler/project11/JackCompiler.py)
+    if-not-goto L     pop, jump to L if the value is 0
+    store-that        pop temp 0 / pop pointer 1 / push temp 0 / pop that 0 in one go
+                      (temp 0 and THAT end up holding the same values)
+    if-XX-goto L      pop y, pop x, jump to L if x XX y, XX is eq/ne/gt/le/lt/ge
+                      (a comparison and the branch on its result, see matchFusedBranch)
+    push stack k      push the value k entries below SP
+    pop stack k       pop into the slot k entries below SP (counted before the pop)
+    drop n            SP -= n
+                      (arguments and locals of inlined functions, see inlineBody)
+    static File.i     static i of File, for statics of functions inlined into another file
+
+"""
+
+from .ir import *
+
+# commands held back by peepholeOptimize, rewrites reach at most this far back
+PEEPHOLE_WINDOW = 64
+
+PUSH_ZERO = VmCommand(Op.PUSH, 'constant', 0)
+PUSH_ONE = VmCommand(Op.PUSH, 'constant', 1)
+PUSH_TRUE = VmCommand(Op.PUSH_TRUE)
+POP_THAT_0 = VmCommand(Op.POP, 'that', 0)
+STORE_THAT = VmCommand(Op.STORE_THAT)
+# the three commands before pop that 0 in an array store
+ARRAY_STORE = [VmCommand(Op.POP, 'temp', 0), VmCommand(Op.POP, 'pointer', 1), VmCommand(Op.PUSH, 'temp', 0)]
+# commands a matchPeephole pattern can end with
+PEEPHOLE_LAST_OPS = frozenset([Op.POP, Op.NEG, Op.NOT, Op.IF_GOTO, Op.IF_NOT_GOTO])
+
+
+"""
+purpose: rewrite windows of vm commands into shorter equivalent sequences
+input: parsed vm commands (any iterable), optional dict counting hits per pattern name, the
+       matchers to use
+output: generator of the rewritten vm commands
+every command is appended to the output and the tail is checked against the patterns, rewritten
+tails are checked again so rewrites chain (push constant 0 / not / if-goto L -> goto L).
+labels are commands too, so a window never spans a jump target. only the last PEEPHOLE_WINDOW
+commands are held back, older ones are passed on, so memory doesn't grow with the input
+"""
+def peepholeOptimize(commands, hits=None, matchers=None):
+    matchers = matchers or [matchPeephole]
+    out = []
+    held = 2 * PEEPHOLE_WINDOW
+    for command in commands:
+        out.append(command)
+        while True:
+            for matcher in matchers:
+                match = matcher(out)
+                if match is not None:
+                    break
+            if match is None:
+                break
+            name, size, replacement = match
+            del out[-size:]
+            out.extend(replacement)
+            if hits is not None:
+                hits[name] = hits.get(name, 0) + 1
+        if len(out) >= held:
+            yield from out[:PEEPHOLE_WINDOW]
+            del out[:PEEPHOLE_WINDOW]
+    yield from out
+
+
+"""
+purpose: find a pattern that ends at the last command
+input: list of vm commands
+output: [pattern name, number of commands it covers, replacement commands] or None
+"""
+def matchPeephole(out):
+    if len(out) < 2:
+        return None
+    last = out[-1]
+    op = last.op
+    if op not in PEEPHOLE_LAST_OPS:
+        return None
+    prev = out[-2]
+
+    # push X i / pop X i: the value goes back where it came from
+    # (not for stack slots, those are counted from SP which the push moves)
+    if (op == Op.POP and prev.op == Op.PUSH and prev.segment == last.segment and prev.arg == last.arg
+            and prev.name == last.name and prev.segment != 'stack'):
+        return ['push X / pop X', 2, []]
+
+    if op == Op.NEG and prev == PUSH_ONE:
+        return ['push constant 1 / neg', 2, [PUSH_TRUE]]
+
+    if op == Op.NOT:
+        if prev == PUSH_ZERO:
+            return ['push constant 0 / not', 2, [PUSH_TRUE]]
+        if prev.op == Op.PUSH_TRUE:
+            return ['push-true / not', 2, [PUSH_ZERO]]
+        if prev.op == Op.NOT:
+            return ['not / not', 2, []]
+
+    if op == Op.IF_GOTO:
+        # not is bitwise: not / if-goto jumps for every x but -1, so only a boolean can skip the not
+        if prev.op == Op.NOT and isBoolean(out, -3):
+            return ['not / if-goto', 2, [VmCommand(Op.IF_NOT_GOTO, name=last.name)]]
+        if prev.op == Op.PUSH_TRUE:
+            return ['push-true / if-goto', 2, [VmCommand(Op.GOTO, name=last.name)]]
+        if prev == PUSH_ZERO:
+            return ['push constant 0 / if-goto', 2, []]
+
+    if op == Op.IF_NOT_GOTO:
+        if prev.op == Op.NOT and isBoolean(out, -3):
+            return ['not / if-not-goto', 2, [VmCommand(Op.IF_GOTO, name=last.name)]]
+        if prev == PUSH_ZERO:
+            return ['push constant 0 / if-not-goto', 2, [VmCommand(Op.GOTO, name=last.name)]]
+        if prev.op == Op.PUSH_TRUE:
+            return ['push-true / if-not-goto', 2, []]
+
+    # array store, a[i] = value with the address under the value on the stack
+    if last == POP_THAT_0 and out[-4:-1] == ARRAY_STORE:
+        return ['pop temp 0 / pop pointer 1 / push temp 0 / pop that 0', 4, [STORE_THAT]]
+
+    return None
+
+
+# whether out[i] is known to push 0 or -1: a comparison, true, false or not of one of those
+def isBoolean(out, i):
+    while -i <= len(out):
+        command = out[i]
+        if command.op in COMPARISON_OPS or command.op == Op.PUSH_TRUE or command == PUSH_ZERO:
+            return True
+        if command.op != Op.NOT:
+            return False
+        i -= 1
+    # passed on already, unknown
+    return False
+
+
+# comparison -> [branch taken when it's true, branch taken when it's false]
+FUSED_BRANCH_OPS = {
+    Op.EQ: [Op.IF_EQ_GOTO, Op.IF_NE_GOTO],
+    Op.GT: [Op.IF_GT_GOTO, Op.IF_LE_GOTO],
+    Op.LT: [Op.IF_LT_GOTO, Op.IF_GE_GOTO],
+}
+
+
+"""
+purpose: find a comparison followed by a branch on its result, ending at the last command
+input: list of vm commands
+output: [pattern name, number of commands it covers, [if-XX-goto L]] or None
+the result never gets pushed, the translator subtracts and jumps in one go
+"""
+def matchFusedBranch(out):
+    last = out[-1]
+    if len(out) < 2 or (last.op != Op.IF_GOTO and last.op != Op.IF_NOT_GOTO):
+        return None
+    prev = out[-2].op
+    if prev in FUSED_BRANCH_OPS:
+        taken, notTaken = FUSED_BRANCH_OPS[prev]
+        if last.op == Op.IF_GOTO:
+            return [f'{OP_TEXT[prev]} / if-goto', 2, [VmCommand(taken, name=last.name)]]
+        return [f'{OP_TEXT[prev]} / if-not-goto', 2, [VmCommand(notTaken, name=last.name)]]
+    if prev == Op.NOT and last.op == Op.IF_GOTO and len(out) >= 3 and out[-3].op in FUSED_BRANCH_OPS:
+        comparison = out[-3].op
+        return [f'{OP_TEXT[comparison]} / not / if-goto', 3,
+                [VmCommand(FUSED_BRANCH_OPS[comparison][1], name=last.name)]]
+    return None
+
+
+"""
+purpose: build the call graph of a whole program
+input: list of parsed vm command lists, one per file
+output: [dict function name -> set of functions it calls, dict function name -> number of vm commands]
+calls made outside any function are listed under None
+"""
+def callGraph(programs):
+    calls = {None: set()}
+    sizes = {}
+    for commands in programs:
+        current = None
+        for command in commands:
+            if command.op == Op.FUNCTION:
+                current = command.name
+                calls[current] = set()
+                sizes[current] = 0
+            elif command.op == Op.CALL:
+                calls[current].add(command.name)
+            if current is not None:
+                sizes[current] += 1
+    return [calls, sizes]
+
+
+"""
+purpose: find every function reachable from the entry function by following calls
+input: call graph from callGraph, name of the entry function
+output: set of reachable function names, None if the entry function isn't defined (nothing can be
+        removed safely then)
+"""
+def reachableFunctions(calls, entry='Sys.init'):
+    if entry not in calls:
+        return None
+    reachable = {entry}
+    # code outside functions runs too
+    work = [entry, None]
+    while work:
+        for callee in calls.get(work.pop(), ()):
+            if callee not in reachable:
+                reachable.add(callee)
+                work.append(callee)
+    return reachable
+
+
+# drops the bodies of functions that aren't in liveFunctions, code before the first function is kept
+def removeDeadFunctions(commands, liveFunctions):
+    keep = True
+    for command in commands:
+        if command.op == Op.FUNCTION:
+            keep = command.name in liveFunctions
+        if keep:
+            yield command
+
+
+# how each command changes the stack depth, commands missing here make a body not inlinable
+STACK_EFFECT = {
+    Op.PUSH: 1, Op.POP: -1,
+    Op.ADD: -1, Op.SUB: -1, Op.AND: -1, Op.OR: -1, Op.EQ: -1, Op.GT: -1, Op.LT: -1,
+    Op.NEG: 0, Op.NOT: 0,
+    Op.LABEL: 0, Op.GOTO: 0, Op.IF_GOTO: -1,
+}
+
+
+"""
+purpose: find the functions that can be inlined at their call sites
+input: dict of file name -> parsed vm commands, largest body (in vm commands) to inline
+output: dict function name -> [file name, number of locals, body commands, pointers the body writes]
+only leaf functions (no calls) qualify
+"""
+def inlineCandidates(programs, maxSize):
+    candidates = {}
+    for fileName, commands in programs.items():
+        current = None
+        for command in commands:
+            if command.op == Op.FUNCTION:
+                current = [fileName, command.arg, [], set()]
+                candidates[command.name] = current
+            elif current is not None:
+                current[2].append(command)
+                if command.op == Op.POP and command.segment == 'pointer':
+                    current[3].add(command.arg)
+    return {
+        name: [fileName, nLocals, body, sorted(pointers)]
+        for name, (fileName, nLocals, body, pointers) in candidates.items()
+        if len(body) <= maxSize and all(command.op in STACK_EFFECT or command.op == Op.RETURN
+                                        for command in body)
+    }
+
+
+"""
+purpose: rewrite a function body to run in place of "call name nArgs"
+input: candidate entry from inlineCandidates, nArgs, prefix that makes the body's labels unique
+output: list of vm commands, None if the stack depth can't be followed through the body
+the arguments stay where the caller pushed them and the locals (then any saved pointers) are pushed
+on top, so argument/local accesses become "push/pop stack k": the slot k entries below SP. that needs
+the stack depth at every command, which is tracked through the body (jumps must agree on it).
+return restores the saved pointers, moves the value down to where the first argument was, drops
+the rest and jumps to the end of the inlined code. statics are qualified with the function's file
+"""
+def inlineBody(candidate, nArgs, prefix):
+    fileName, nLocals, body, pointers = candidate
+    out = [PUSH_ZERO] * nLocals + [VmCommand(Op.PUSH, 'pointer', pointer) for pointer in pointers]
+    # entries above the first argument's slot
+    depth = nArgs + nLocals + len(pointers)
+    labelDepths = {}
+    # labels met in unreachable code, nothing may jump to them later
+    deadLabels = set()
+    endLabel = f'{prefix}return'
+    jumpsToEnd = False
+
+    for i, command in enumerate(body):
+        op = command.op
+        if depth is None and op != Op.LABEL:
+            # unreachable, nothing jumps past a goto/return without a label
+            continue
+        if op == Op.RETURN:
+            if depth < 1:
+                return None
+            for slot, pointer in enumerate(pointers):
+                out.append(VmCommand(Op.PUSH, 'stack', depth - (nArgs + nLocals + slot)))
+                out.append(VmCommand(Op.POP, 'pointer', pointer))
+            if depth >= 2:
+                out.append(VmCommand(Op.POP, 'stack', depth))
+                if depth > 2:
+                    out.append(VmCommand(Op.DROP, arg=depth - 2))
+            if i < len(body) - 1:
+                out.append(VmCommand(Op.GOTO, name=endLabel))
+                jumpsToEnd = True
+            depth = None
+            continue
+
+        if op == Op.LABEL or op == Op.GOTO or op == Op.IF_GOTO:
+            label = command.name
+            if op == Op.IF_GOTO:
+                depth -= 1
+            if op == Op.LABEL and depth is None:
+                depth = labelDepths.get(label)
+                if depth is None:
+                    # only reachable by a jump further down, if any: the code after it stays dead
+                    deadLabels.add(label)
+                    continue
+            if label in deadLabels or labelDepths.setdefault(label, depth) != depth:
+                return None
+            out.append(VmCommand(op, name=f'{prefix}{label}'))
+            if op == Op.GOTO:
+                depth = None
+            continue
+
+        if op in MEMORY_OPS and command.segment in ('argument', 'local'):
+            index = command.arg + (nArgs if command.segment == 'local' else 0)
+            if depth - index < 1:
+                return None
+            out.append(VmCommand(op, 'stack', depth - index))
+        elif op in MEMORY_OPS and command.segment == 'static':
+            out.append(VmCommand(op, 'static', command.arg, command.name or fileName))
+        else:
+            out.append(command)
+        depth += STACK_EFFECT[op]
+        if depth < nArgs + nLocals + len(pointers):
+            # popped below its own pushes, into the locals or saved pointers
+            return None
+
+    if depth is not None:
+        # fell off the end without returning
+        return None
+    if jumpsToEnd:
+        out.append(VmCommand(Op.LABEL, name=endLabel))
+    return out
+
+
+"""
+purpose: replace calls to inlinable functions with their bodies
+input: parsed vm commands of one file, candidates from inlineCandidates, the file's name, optional
+       dict counting inlined calls per function
+output: generator of vm commands
+"""
+def inlineCalls(commands, candidates, fileName, hits=None):
+    site = 0
+    for command in commands:
+        if command.op == Op.CALL and command.name in candidates:
+            site += 1
+            body = inlineBody(candidates[command.name], command.arg, f'inline{site}.{command.name}$')
+            if body is not None:
+                yield from body
+                if hits is not None:
+                    hits[command.name] = hits.get(command.name, 0) + 1
+                continue
+        yield command